@@ -0,0 +1,228 @@
+# Benchmark suite of the analysis pipelines on synthetic inputs. Every stage (log
+# parsing, sorting, window joins, histogram filling, TP reading, sorting and
+# dataset writing) is timed and memory profiled at each input size, so scaling
+# regressions show up as soon as they are introduced. The nested-loop joins the
+# latency script started from are kept here as the reference baseline.
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import tempfile
+import time
+import tracemalloc
+from daq_log import ParseLog
+from daq_trigger_latencies import SortTable, GetWindowTable, GetTraceTable, GetTraceLatencies, LatencyHistogram
+from tp_io import read_tp_file, write_tp_text, write_tp_binary, iter_time_ordered_tps, DATASET_ORDER
+from synthetic_data import write_daq_log, write_blocky_tps
+
+DEFAULT_SIZES = "1e4,1e5,1e6"
+
+# Largest input the nested-loop baseline is run at, it is quadratic
+BASELINE_MAX_SIZE = 10**5
+
+
+def measure(function, *args, memory=True):
+    """
+    Time a call, and measure its peak traced memory in a second call under
+    tracemalloc, which numpy reports its allocations to. Tracing slows down
+    python level code, so it is kept out of the timed call.
+    :return: result of the timed call, wall seconds, CPU seconds, peak MB (nan without memory)
+    """
+    with contextlib.redirect_stdout(io.StringIO()):
+        wall, cpu = time.perf_counter(), time.process_time()
+        result = function(*args)
+        wall, cpu = time.perf_counter() - wall, time.process_time() - cpu
+        peak = math.nan
+        if memory:
+            tracemalloc.start()
+            function(*args)
+            peak = tracemalloc.get_traced_memory()[1]/1024**2
+            tracemalloc.stop()
+    return result, wall, cpu, peak
+
+
+def baseline_join(tp_received, td_sent, tp_requests):
+    """
+    The original nested-loop joins: every TP list scan per TP request and per
+    TriggerDecision, stopping past the window end, and every DataRequest per
+    TriggerDecision.
+    :return: number of TP-DR, TP-TD and TD-DR latencies
+    """
+    tps = tp_received.tolist()
+    tp_dr, tp_td, td_dr = [], [], []
+    for window_begin, window_end, time_received, time_handled in tp_requests.tolist():
+        for time_start, _, time_intrigger, time_inbuffer in tps:
+            if window_begin <= time_start <= window_end:
+                tp_dr.append(((time_handled - time_intrigger)/1e9, (time_received - time_intrigger)/1e9,
+                              (time_received - time_inbuffer)/1e9))
+            elif time_start > window_end:
+                break
+    for readout_start, readout_end, time_td_sent in td_sent.tolist():
+        for time_start, _, time_intrigger, time_inbuffer in tps:
+            if readout_start <= time_start <= readout_end:
+                tp_td.append(((time_td_sent - time_intrigger)/1e9, (time_td_sent - time_inbuffer)/1e9))
+            elif time_start > readout_end:
+                break
+    requests = tp_requests.tolist()
+    for readout_start, readout_end, time_td_sent in td_sent.tolist():
+        for window_begin, window_end, time_received, _ in requests:
+            if readout_start == window_begin and readout_end == window_end:
+                td_dr.append((time_received - time_td_sent)/1e9)
+    return len(tp_dr), len(tp_td), len(td_dr)
+
+
+def fill_histograms(tables):
+    """
+    Fill a 100 bin histogram over the range of every latency column.
+    """
+    for table in tables:
+        for column in table.dtype.names:
+            values = table[column]
+            if len(values):
+                LatencyHistogram.Linear(100, values.min(), values.max()).Fill(values)
+
+
+def sort_external(file):
+    """
+    Consume the external merge sort of a TP text file.
+    """
+    return sum(len(block) for block in iter_time_ordered_tps(file))
+
+
+def run_log_stages(size, tmp_dir, memory, baseline_max):
+    """
+    Benchmark the latency pipeline stages on a synthetic log of size TPs.
+    :return: list of (stage, records in, wall, cpu, peak MB)
+    """
+    log = os.path.join(tmp_dir, "daq.log")
+    write_daq_log(log, size)
+    results = []
+
+    records, wall, cpu, peak = measure(ParseLog, log, memory=memory)
+    results.append(("log parse", size, wall, cpu, peak))
+    tp_received, td_sent, tp_requests = records['tp_received'], records['td_sent'], records['tp_requests']
+
+    tp_sorted, wall, cpu, peak = measure(SortTable, tp_received, 'time_start', memory=memory)
+    results.append(("log sort", size, wall, cpu, peak))
+
+    windows, wall, cpu, peak = measure(GetWindowTable, td_sent, tp_requests, memory=memory)
+    results.append(("window join", len(td_sent) + len(tp_requests), wall, cpu, peak))
+    trace, wall, cpu, peak = measure(GetTraceTable, tp_sorted, windows, memory=memory)
+    results.append(("trace join", size, wall, cpu, peak))
+    tables, wall, cpu, peak = measure(GetTraceLatencies, trace, memory=memory)
+    results.append(("latencies", len(trace), wall, cpu, peak))
+
+    _, wall, cpu, peak = measure(fill_histograms, tables, memory=memory)
+    results.append(("histogram fill", sum(len(table) for table in tables), wall, cpu, peak))
+
+    if size <= baseline_max:
+        _, wall, cpu, peak = measure(baseline_join, tp_sorted, td_sent, tp_requests, memory=memory)
+        results.append(("baseline nested-loop join", size, wall, cpu, peak))
+    os.remove(log)
+    return results
+
+
+def run_tp_stages(size, tmp_dir, memory):
+    """
+    Benchmark the dataset pipeline stages on a synthetic blocky TP dump of size TPs.
+    :return: list of (stage, records in, wall, cpu, peak MB)
+    """
+    dump = os.path.join(tmp_dir, "tps.txt")
+    out = os.path.join(tmp_dir, "dataset")
+    write_blocky_tps(dump, size)
+    results = []
+
+    data, wall, cpu, peak = measure(read_tp_file, dump, memory=memory)
+    results.append(("tp read", size, wall, cpu, peak))
+    data, wall, cpu, peak = measure(lambda rows: rows[rows[:, 0].argsort(kind='stable')], data, memory=memory)
+    results.append(("tp sort", size, wall, cpu, peak))
+    _, wall, cpu, peak = measure(sort_external, dump, memory=memory)
+    results.append(("tp external sort", size, wall, cpu, peak))
+
+    dataset = data[:, DATASET_ORDER]
+    _, wall, cpu, peak = measure(write_tp_text, out + ".txt", dataset, memory=memory)
+    results.append(("dataset write text", size, wall, cpu, peak))
+    _, wall, cpu, peak = measure(write_tp_binary, out + ".bin", dataset, memory=memory)
+    results.append(("dataset write binary", size, wall, cpu, peak))
+    for file in (dump, out + ".txt", out + ".bin"):
+        os.remove(file)
+    return results
+
+
+def get_scaling(results):
+    """
+    Fit the scaling exponent of each stage, wall time ~ size^k, between the
+    smallest and the largest size it ran at.
+    :return: dictionary of stage to exponent
+    """
+    scaling = {}
+    for stage in dict.fromkeys(result["stage"] for result in results):
+        points = [(result["size"], result["wall_s"]) for result in results if result["stage"] == stage]
+        (size_low, wall_low), (size_high, wall_high) = min(points), max(points)
+        if size_high > size_low and wall_low > 0:
+            scaling[stage] = math.log(wall_high/wall_low)/math.log(size_high/size_low)
+    return scaling
+
+
+def compare(results, reference_file, tolerance):
+    """
+    Print the stages that got slower than tolerance times a reference benchmark.
+    :return: number of regressions
+    """
+    with open(reference_file) as f:
+        reference = {(result["stage"], result["size"]): result["wall_s"] for result in json.load(f)["results"]}
+    regressions = 0
+    for result in results:
+        before = reference.get((result["stage"], result["size"]))
+        if before and result["wall_s"] > tolerance*before:
+            regressions += 1
+            print("REGRESSION ", result["stage"], " at ", result["size"], ": ", round(before, 4), " s -> ",
+                  round(result["wall_s"], 4), " s")
+    print(regressions, " regressions against ", reference_file)
+    return regressions
+
+
+def main(sizes, output, memory, baseline_max, reference, tolerance, tmp_dir=None):
+    results = []
+    print("size  stage  records_in  wall(s)  cpu(s)  peak(MB)  records/s")
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as work_dir:
+        for size in sizes:
+            for stage, records_in, wall, cpu, peak in (run_log_stages(size, work_dir, memory, baseline_max)
+                                                       + run_tp_stages(size, work_dir, memory)):
+                results.append({"size": size, "stage": stage, "records_in": int(records_in), "wall_s": wall,
+                                "cpu_s": cpu, "peak_mb": None if math.isnan(peak) else peak,
+                                "records_per_s": records_in/wall if wall > 0 else None})
+                print(size, " ", stage, " ", records_in, " ", round(wall, 4), " ", round(cpu, 4), " ",
+                      round(peak, 1), " ", round(records_in/wall) if wall > 0 else "-")
+
+    print("\nScaling exponents, wall time ~ size^k:")
+    for stage, exponent in get_scaling(results).items():
+        print("  ", stage, ": ", round(exponent, 2))
+    if output:
+        with open(output, 'w') as f:
+            json.dump({"sizes": sizes, "results": results}, f, indent=1)
+        print("Saved the results to ", output)
+    if reference:
+        compare(results, reference, tolerance)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark the analysis pipeline stages on synthetic inputs")
+    parser.add_argument('-s', '--sizes', dest='sizes', default=DEFAULT_SIZES,
+                        help='Comma separated numbers of TPs to run at, e.g. 1e4,1e5,1e6,1e7')
+    parser.add_argument('-o', '--output', dest='output', default=None, help='Save the results as JSON')
+    parser.add_argument('--no-memory', dest='memory', action='store_false',
+                        help='Skip the tracemalloc pass of every stage, halving the run time')
+    parser.add_argument('--baseline-max', dest='baseline_max', type=float, default=BASELINE_MAX_SIZE,
+                        help='Largest size the quadratic nested-loop baseline is run at')
+    parser.add_argument('--compare', dest='reference', default=None,
+                        help='JSON results of an earlier benchmark to report regressions against')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=1.5,
+                        help='Slowdown factor reported as a regression with --compare')
+    parser.add_argument('--tmp-dir', dest='tmp_dir', default=None, help='Directory for the synthetic inputs')
+
+    args = parser.parse_args()
+    main([int(float(size)) for size in args.sizes.split(",")], args.output, args.memory, args.baseline_max,
+         args.reference, args.tolerance, args.tmp_dir)
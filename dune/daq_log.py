@@ -0,0 +1,468 @@
+"""
+Parsing of the DAQ logs into columnar record tables.
+
+Every log record type is a numpy structured array with one int64 column per
+parsed token (in the same order as the tokens). Timestamps are kept as integer
+nanoseconds.
+"""
+import gzip
+import hashlib
+import lzma
+import os
+import re
+import shutil
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
+import numpy as np
+
+# Received TP data
+TP_RECEIVED_DTYPE = np.dtype([('time_start',     np.int64),
+                              ('adc_integral',   np.int64),
+                              ('time_intrigger', np.int64),
+                              ('time_inbuffer',  np.int64)])
+
+# TP request from the TPBuffer
+TP_REQUEST_DTYPE = np.dtype([('window_begin',  np.int64),
+                             ('window_end',    np.int64),
+                             ('time_received', np.int64),
+                             ('time_handled',  np.int64)])
+
+# TriggerDecision sent by the MLT
+TD_SENT_DTYPE = np.dtype([('readout_start', np.int64),
+                          ('readout_end',   np.int64),
+                          ('time_td_sent',  np.int64)])
+
+# Default size of the blocks the log is read in
+READ_BLOCK_SIZE = 64*1024*1024
+
+# Extensions of the compressed logs OpenLog decompresses on the fly
+COMPRESSED_SUFFIXES = ('.gz', '.xz', '.zst')
+
+# Bump whenever the parsed tables change, so stale cache entries are not used
+PARSER_VERSION = 1
+
+# Default location and size limit of the parsed-log cache
+CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'nuscripts', 'daq_logs')
+CACHE_SIZE = 2*1024*1024*1024
+
+@dataclass(frozen=True)
+class RecordType:
+    """
+    Description of one record type in the DAQ log
+    """
+    prefix: bytes
+    tokens: tuple
+    dtype: np.dtype
+
+    @property
+    def line_pattern(self):
+        """
+        Pattern matching the prefix and all the tokens of a line, in order.
+        """
+        return re.compile(re.escape(self.prefix) +
+                          b''.join(rb'[^\n]*?' + re.escape(token) + rb' (-?\d+)' for token in self.tokens))
+
+    @property
+    def token_patterns(self):
+        """
+        Patterns matching each token individually, in any order.
+        """
+        return [re.compile(re.escape(token) + rb' (-?\d+)') for token in self.tokens]
+
+RECORD_TYPES = {
+    'tp_requests': RecordType(b'TPs Requested:',
+                              (b'window_begin:', b'window_end:', b'real_time_req:', b'real_time_han:'),
+                              TP_REQUEST_DTYPE),
+    'td_sent':     RecordType(b'MLT TD Sent:',
+                              (b'readout_start:', b'readout_end:', b'time_td_sent:'),
+                              TD_SENT_DTYPE),
+    'tp_received': RecordType(b'TPs Received.',
+                              (b'time_start:', b'ADC integral:', b'real_time_in:', b'real_time_buff:'),
+                              TP_RECEIVED_DTYPE),
+}
+
+# The patterns are compiled only once
+_LINE_PATTERNS = {name: record.line_pattern for name, record in RECORD_TYPES.items()}
+_TOKEN_PATTERNS = {name: record.token_patterns for name, record in RECORD_TYPES.items()}
+
+def ParseLine(_line, _name):
+    """
+    Extracts the tokens of one record from a log line, wherever they are after
+    the record prefix.
+
+    parameters:
+        _line: whole line of the log, in bytes
+        _name: record type name in RECORD_TYPES
+
+    return:
+        list of the token values, in the record's column order
+    """
+    start = _line.find(RECORD_TYPES[_name].prefix)
+    values = []
+    for token, pattern in zip(RECORD_TYPES[_name].tokens, _TOKEN_PATTERNS[_name]):
+        match = pattern.search(_line, start)
+        if match is None:
+            raise ValueError(f"No '{token.decode()}' number in line: {_line.decode(errors='replace')}")
+        values.append(int(match.group(1)))
+    return values
+
+def ParseChunk(_chunk):
+    """
+    Parses every record type out of a block of complete log lines.
+
+    The whole block is scanned once per record type with a precompiled pattern.
+    If some prefixed lines do not match it (tokens in an unexpected order), the
+    block falls back to the slower line-by-line token search for that type.
+
+    parameters:
+        _chunk: bytes holding complete lines of the log
+
+    return:
+        dictionary of record name to record table
+    """
+    tables = {}
+    for name, record in RECORD_TYPES.items():
+        values = array('q')
+        for match in _LINE_PATTERNS[name].finditer(_chunk):
+            values.extend(map(int, match.groups()))
+
+        if len(values) != _chunk.count(record.prefix)*len(record.tokens):
+            values = array('q')
+            for line in _chunk.splitlines():
+                if record.prefix in line:
+                    values.extend(ParseLine(line, name))
+
+        tables[name] = np.frombuffer(values, dtype=record.dtype).copy()
+    return tables
+
+def ConcatenateTables(_tables_list):
+    """
+    Joins a list of per-block record table dictionaries, keeping block order.
+    """
+    return {name: np.concatenate([tables[name] for tables in _tables_list] +
+                                 [np.empty(0, dtype=record.dtype)])
+            for name, record in RECORD_TYPES.items()}
+
+def OpenLog(_file):
+    """
+    Opens a DAQ log for binary reading. Logs ending in .gz, .xz or .zst are
+    decompressed on the fly (.zst needs the zstandard package).
+
+    parameters:
+        _file: DAQ log file
+    """
+    if _file.endswith('.gz'):
+        return gzip.open(_file, 'rb')
+    if _file.endswith('.xz'):
+        return lzma.open(_file, 'rb')
+    if _file.endswith('.zst'):
+        try:
+            import zstandard
+        except ImportError:
+            raise ImportError("Reading .zst DAQ logs requires the zstandard package")
+        return zstandard.ZstdDecompressor().stream_reader(open(_file, 'rb'), closefd=True)
+    return open(_file, 'rb')
+
+def IterBlocks(_input_file, _block_size, _length=None):
+    """
+    Reads an open binary file in blocks of complete lines.
+
+    parameters:
+        _input_file: binary file object, positioned at the start of a line
+        _block_size: number of bytes read per block
+        _length: number of bytes to read, or None to read until the end
+
+    return:
+        generator of bytes blocks, each ending at a line boundary
+    """
+    remainder = b''
+    while _length is None or _length > 0:
+        size = _block_size if _length is None else min(_block_size, _length)
+        block = _input_file.read(size)
+        if not block:
+            break
+        if _length is not None:
+            _length -= len(block)
+        block = remainder + block
+        last_newline = block.rfind(b'\n') + 1
+        remainder = block[last_newline:]
+        yield block[:last_newline]
+    if remainder:
+        yield remainder
+
+def IterLogBatches(_file, _block_size=READ_BLOCK_SIZE):
+    """
+    Streams the DAQ log in fixed-size blocks cut at the last full line, and
+    yields the record tables of each block as soon as it is parsed. Only one
+    block of text is held in memory at a time.
+
+    parameters:
+        _file: DAQ log file, optionally compressed
+        _block_size: number of bytes read per block
+
+    return:
+        generator of dictionaries of record name to record table
+    """
+    with OpenLog(_file) as input_file:
+        for block in IterBlocks(input_file, _block_size):
+            yield ParseChunk(block)
+
+def AlignToLine(_input_file, _offset):
+    """
+    Gets the offset of the first line starting at or after a byte offset.
+    """
+    if _offset == 0:
+        return 0
+    _input_file.seek(_offset - 1)
+    _input_file.readline()
+    return _input_file.tell()
+
+def ParseByteRange(_file, _begin, _end, _block_size=READ_BLOCK_SIZE):
+    """
+    Parses the lines of an uncompressed DAQ log that start within the
+    [_begin, _end) byte range. Neighbouring ranges therefore split the log at
+    line boundaries without losing or repeating any line.
+
+    parameters:
+        _file: uncompressed DAQ log file
+        _begin: first byte of the range
+        _end: byte after the end of the range
+        _block_size: number of bytes read per block
+
+    return:
+        dictionary of record name to record table
+    """
+    with open(_file, 'rb') as input_file:
+        end = AlignToLine(input_file, _end)
+        begin = AlignToLine(input_file, _begin)
+        input_file.seek(begin)
+        return ConcatenateTables([ParseChunk(block) for block in
+                                  IterBlocks(input_file, _block_size, end - begin)])
+
+def ParseLogParallel(_file, _jobs, _block_size=READ_BLOCK_SIZE):
+    """
+    Parses an uncompressed DAQ log with a pool of _jobs processes. The file is
+    split into equal byte ranges, a few per process for load balancing, and
+    the tables are concatenated in file order, identically to a serial parse.
+
+    parameters:
+        _file: uncompressed DAQ log file
+        _jobs: number of worker processes
+        _block_size: number of bytes read per block
+
+    return:
+        dictionary of record name to record table
+    """
+    size = os.path.getsize(_file)
+    n_ranges = max(1, min(4*_jobs, size//(1024*1024)))
+    edges = [size*i//n_ranges for i in range(n_ranges + 1)]
+    with ProcessPoolExecutor(max_workers=_jobs) as pool:
+        tables = list(pool.map(ParseByteRange, [_file]*n_ranges, edges[:-1], edges[1:],
+                               [_block_size]*n_ranges))
+    return ConcatenateTables(tables)
+
+def ParseLog(_file, _block_size=READ_BLOCK_SIZE, _jobs=1):
+    """
+    Parses all the record types from the DAQ log in a single streaming pass
+    over the file. Only the compact record tables are kept, so the log itself
+    can be larger than the memory.
+
+    parameters:
+        _file: DAQ log file, optionally compressed
+        _block_size: number of bytes read per block
+        _jobs: number of processes parsing an uncompressed log in parallel
+
+    return:
+        dictionary of record name ('tp_requests', 'td_sent', 'tp_received') to
+        record table
+    """
+    if _jobs > 1 and _file.endswith(COMPRESSED_SUFFIXES):
+        print("Compressed logs can not be split, parsing serially")
+        _jobs = 1
+
+    if _jobs > 1:
+        tables = ParseLogParallel(_file, _jobs, _block_size)
+    else:
+        tables = ConcatenateTables(list(IterLogBatches(_file, _block_size)))
+    for name, table in tables.items():
+        print(f"Parsed {len(table)} {name} records from {_file}")
+    return tables
+
+class LogTail:
+    """
+    Follows a growing, uncompressed DAQ log and parses only the bytes appended
+    since the previous poll. An incomplete last line is kept until the rest of
+    it is written.
+    """
+    def __init__(self, _file, _block_size=READ_BLOCK_SIZE):
+        if _file.endswith(COMPRESSED_SUFFIXES):
+            raise ValueError(f"Can not follow the compressed log {_file}, follow the uncompressed log being written")
+        self.m_file = _file
+        self.m_block_size = _block_size
+        self.m_offset = 0
+        self.m_remainder = b''
+
+    def Poll(self):
+        """
+        Parses the lines appended to the log since the last poll.
+
+        return:
+            dictionary of record name to record table of the new records
+        """
+        size = os.path.getsize(self.m_file)
+        if size < self.m_offset:
+            print(f"{self.m_file} was truncated, reading it from the start")
+            self.m_offset = 0
+            self.m_remainder = b''
+
+        tables = []
+        with open(self.m_file, 'rb') as input_file:
+            input_file.seek(self.m_offset)
+            while self.m_offset < size:
+                block = input_file.read(min(self.m_block_size, size - self.m_offset))
+                if not block:
+                    break
+                self.m_offset += len(block)
+                block = self.m_remainder + block
+                last_newline = block.rfind(b'\n') + 1
+                self.m_remainder = block[last_newline:]
+                tables.append(ParseChunk(block[:last_newline]))
+        return ConcatenateTables(tables)
+
+def GetCacheKey(_file):
+    """
+    Gets the cache entry name of a DAQ log. The first part only depends on the
+    log's path, the second part on its size, modification time and the parser
+    version, so a changed log gets a new entry.
+
+    parameters:
+        _file: DAQ log file
+    """
+    path = os.path.abspath(_file)
+    stat = os.stat(path)
+    fingerprint = f"{path}:{stat.st_size}:{stat.st_mtime_ns}:{PARSER_VERSION}"
+    return (hashlib.sha1(path.encode()).hexdigest()[:16] + '-' +
+            hashlib.sha1(fingerprint.encode()).hexdigest()[:16])
+
+def GetCacheEntries(_cache_dir):
+    """
+    Lists the cache entries as (last used time, size in bytes, path) tuples,
+    least recently used first. Entries removed by another process while they
+    are being listed are skipped.
+    """
+    entries = []
+    for name in os.listdir(_cache_dir):
+        path = os.path.join(_cache_dir, name)
+        if name.startswith('.') or not os.path.isdir(path):
+            continue
+        try:
+            size = sum(os.path.getsize(os.path.join(path, table)) for table in os.listdir(path))
+            entries.append((os.path.getmtime(path), size, path))
+        except OSError:
+            continue
+    return sorted(entries)
+
+def EvictCache(_cache_dir, _cache_size, _keep=None):
+    """
+    Removes the least recently used cache entries until the cache fits in the
+    size limit. The _keep entry is never removed.
+
+    parameters:
+        _cache_dir: parsed-log cache directory
+        _cache_size: cache size limit in bytes
+        _keep: path of the entry to keep
+    """
+    entries = GetCacheEntries(_cache_dir)
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, path in entries:
+        if total_size <= _cache_size:
+            break
+        if path == _keep:
+            continue
+        shutil.rmtree(path, ignore_errors=True)
+        total_size -= size
+
+def LoadCachedLog(_file, _cache_dir):
+    """
+    Loads the record tables of a DAQ log from the cache as read-only memory
+    maps. Stale entries of the same log are removed. An entry evicted by
+    another process while it is being loaded counts as a miss.
+
+    parameters:
+        _file: DAQ log file
+        _cache_dir: parsed-log cache directory
+
+    return:
+        dictionary of record name to record table, or None on a cache miss
+    """
+    key = GetCacheKey(_file)
+    entry = os.path.join(_cache_dir, key)
+    if not os.path.isdir(entry):
+        path_hash = key.split('-')[0]
+        for name in os.listdir(_cache_dir):
+            if name.startswith(path_hash + '-'):
+                shutil.rmtree(os.path.join(_cache_dir, name), ignore_errors=True)
+        return None
+
+    try:
+        # Mark the entry as recently used
+        os.utime(entry)
+        return {name: np.load(os.path.join(entry, name + '.npy'), mmap_mode='r') for name in RECORD_TYPES}
+    except OSError:
+        return None
+
+def SaveCachedLog(_file, _tables, _cache_dir, _cache_size=CACHE_SIZE, _key=None):
+    """
+    Saves the record tables of a DAQ log as .npy sidecar files in the cache,
+    then evicts old entries to respect the size limit. The entry is written to
+    a temporary directory first, so readers never see partial entries.
+
+    parameters:
+        _file: DAQ log file
+        _tables: dictionary of record name to record table
+        _cache_dir: parsed-log cache directory
+        _cache_size: cache size limit in bytes
+        _key: cache key of the log as it was when it was parsed, computed from
+              the current log if None
+    """
+    entry = os.path.join(_cache_dir, _key if _key is not None else GetCacheKey(_file))
+    temporary = os.path.join(_cache_dir, f".{os.path.basename(entry)}.{os.getpid()}")
+    os.makedirs(temporary, exist_ok=True)
+    for name, table in _tables.items():
+        np.save(os.path.join(temporary, name + '.npy'), table)
+    try:
+        os.rename(temporary, entry)
+    except OSError:
+        # Another process cached the same log in the meantime
+        shutil.rmtree(temporary, ignore_errors=True)
+    EvictCache(_cache_dir, _cache_size, entry)
+
+def ParseLogCached(_file, _cache_dir=CACHE_DIR, _cache_size=CACHE_SIZE, _block_size=READ_BLOCK_SIZE, _jobs=1):
+    """
+    Same as ParseLog, but reuses the record tables of a previous run on the
+    same, unchanged log from the cache directory.
+
+    parameters:
+        _file: DAQ log file, optionally compressed
+        _cache_dir: parsed-log cache directory
+        _cache_size: cache size limit in bytes
+        _block_size: number of bytes read per block
+        _jobs: number of processes parsing an uncompressed log in parallel
+    """
+    os.makedirs(_cache_dir, exist_ok=True)
+    tables = LoadCachedLog(_file, _cache_dir)
+    if tables is not None:
+        for name, table in tables.items():
+            print(f"Loaded {len(table)} cached {name} records for {_file}")
+        return tables
+
+    # The log is fingerprinted before parsing, so records of a log that is
+    # still being written are never cached under the key of the grown log
+    key = GetCacheKey(_file)
+    tables = ParseLog(_file, _block_size, _jobs)
+    if GetCacheKey(_file) != key:
+        print(f"{_file} changed while it was parsed, not caching its records")
+        return tables
+    SaveCachedLog(_file, tables, _cache_dir, _cache_size, key)
+    return tables
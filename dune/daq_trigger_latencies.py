@@ -1,193 +1,605 @@
+import glob
 import os
-from tqdm import tqdm
-from dataclasses import dataclass
-import ROOT
+import time
+from array import array
+from collections import Counter, deque
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+from daq_log import ParseLog, ParseLogCached, LogTail, READ_BLOCK_SIZE, CACHE_DIR, CACHE_SIZE, COMPRESSED_SUFFIXES
+from daq_log import TP_RECEIVED_DTYPE, TP_REQUEST_DTYPE, TD_SENT_DTYPE
+from profiling import StageProfiler, NO_PROFILER
 
-# TODO: Change these @dataclasses to numpy matrices?
+# ROOT is slow to start and heavy on memory, so it is only imported once a ROOT
+# plot is requested, see GetROOT()
+ROOT = None
 
-class TPSetData:
+# Plotting backends: ROOT, matplotlib, or only exporting the histogram contents
+BACKENDS = ('root', 'mpl', 'none')
+
+# Output file name and ROOT histogram title of each latency column
+LATENCY_PLOTS = {
+    'latency_dr_received_to_handled':   ("latency_DRReceived_to_DRHandled.png",
+                                         "Latency: DataRequest Received to DataRequest handled;#Delta t(s);Number of TPs"),
+    'latency_tp_received_to_buffered':  ("latency_TPReceived_to_TPBuffered.png",
+                                         "Latency: TPSet Received to TPSet buffered;#Delta t(s);Number of TPs"),
+    'latency_td_to_dr':                 ("latency_TriggerDecision_to_DRReceived.png",
+                                         "Latency: MLT Trigger Decision Sent to DataRequest Received;#Delta t(s);Number of DataRequests"),
+    'latency_tptrigger_to_tdsent':      ("latency_TPReceived_to_TDSent.png",
+                                         "Latency: TPSet Received to MLT Trigger Decision Sent;#Delta t(s);Number of TPs"),
+    'latency_tpbuffered_to_tdsent':     ("latency_TPBuffered_to_TDSent.png",
+                                         "Latency: TPSet Buffered to MLT Trigger Decision Sent;#Delta t(s);Number of TPs"),
+    'latency_tptrigger_to_drhandled':   ("latency_TPReceived_to_DRHandled.png",
+                                         "Latency: TPSet Received to DataRequest Handled;#Delta t(s);Number of TPs"),
+    'latency_tptrigger_to_drreceived':  ("latency_TPReceived_to_DRReceived.png",
+                                         "Latency: TPSet Received to DataRequest Received;#Delta t(s);Number of TPs"),
+    'latency_tpbuffered_to_drreceived': ("latency_TPBuffered_to_DRReceived.png",
+                                         "Latency: TPSet Buffered to DataRequest Received;#Delta t(s);Number of TPs"),
+}
+
+def GetLatency(_time_later, _time_earlier):
     """
-    Class for the received TP data
+    Calculates the latency in seconds between two columns of ns timestamps.
     """
-    def __init__(self, _time_start, _adc_integral, _time_intrigger, _time_inbuffer):
-        self.m_time_start       = int(_time_start)
-        self.m_adc_integral     = int(_adc_integral)
-        self.m_time_intrigger   = int(_time_intrigger)
-        self.m_time_inbuffer    = int(_time_inbuffer)
-        self.m_latency_tp_received_to_buffered = (_time_inbuffer - _time_intrigger)/1e9
+    return (_time_later - _time_earlier)/1e9
 
-class TPDataRequest:
+def MakeTable(**_columns):
     """
-    Class for the TP request from the TPBuffer
+    Packs equally long numpy columns into a single structured array, keyed by
+    the keyword names.
     """
-    def __init__(self, _window_begin, _window_end, _time_received, _time_handled):
-        self.m_window_begin = int(_window_begin)
-        self.m_window_end   = int(_window_end)
-        self.m_time_received= int(_time_received)
-        self.m_time_handled = int(_time_handled)
-        self.m_latency_dr_received_to_handled = (_time_handled - _time_received)/1e9
+    length = len(next(iter(_columns.values())))
+    table = np.empty(length, dtype=[(name, column.dtype) for name, column in _columns.items()])
+    for name, column in _columns.items():
+        table[name] = column
+    return table
 
-@dataclass
-class TPLatency:
+def SortTable(_table, _column):
     """
-    Class for the TP latency data
+    Returns the record table stably sorted by one of its columns.
     """
-    m_latency_tptrigger_to_drhandled: int
-    m_latency_tptrigger_to_drreceived: int
-    m_latency_tpbuffered_to_drreceived: int
-
-    def __str__(self):
-        return f"{self.m_latency_tptrigger_to_drhandled}-{self.m_latency_tptrigger_to_drreceived}"
+    return _table[np.argsort(_table[_column], kind='stable')]
 
-@dataclass
-class MLTDRLatency:
+def GetTPReceivedLatencies(_tp_received):
     """
-    This is dumb, but that's how I have to do it for now because of how the plotting script is written...
-    TODO: Change all of this to numpy arrays
+    Calculates the TPSet received to TPSet buffered latency of each received TP.
+
+    parameters:
+        _tp_received: TP_RECEIVED_DTYPE table
     """
-    m_latency_td_to_dr: int
+    return MakeTable(latency_tp_received_to_buffered=GetLatency(_tp_received['time_inbuffer'],
+                                                                _tp_received['time_intrigger']))
 
-@dataclass
-class TPMLTLatency:
+def GetDRLatencies(_tp_requests):
     """
-    Data class holding the TP->TR latencies
+    Calculates the DataRequest received to DataRequest handled latency of each
+    TP request.
+
+    parameters:
+        _tp_requests: TP_REQUEST_DTYPE table
     """
-    m_latency_tptrigger_to_tdsent: int
-    m_latency_tpbuffered_to_tdsent: int
+    return MakeTable(latency_dr_received_to_handled=GetLatency(_tp_requests['time_handled'],
+                                                               _tp_requests['time_received']))
 
-@dataclass
-class MLTTriggerDecision:
+def GetWindowMatches(_times, _window_begin, _window_end):
     """
-    Class for the MLT latency data
+    Joins sorted TP start times with a set of [begin, end] windows (overlapping
+    windows are allowed). Each window is located in the times with two binary
+    searches, so the cost is O(M log N + K) for M windows, N times and K
+    matched pairs, instead of scanning all the TPs for every window.
+
+    parameters:
+        _times: sorted array of TP start times
+        _window_begin: array of window start times (inclusive)
+        _window_end: array of window end times (inclusive)
+
+    return:
+        (window_index, time_index) arrays with one entry per matched pair,
+        ordered by window and by time within each window
     """
-    #m_tpsets: int
-    #m_tpdatarequests: int
-    m_readout_start: int
-    m_readout_end: int
-    m_latency_mlt_td_to_dfo: int
+    lo = np.searchsorted(_times, _window_begin, side='left')
+    hi = np.searchsorted(_times, _window_end, side='right')
+    counts = np.maximum(hi - lo, 0)
 
-    def __str__(self):
-        return f"{self.m_readout_start}-{self.m_readout_start}"
+    window_index = np.repeat(np.arange(len(counts)), counts)
+    # Offset of each pair within its window, shifted to the window's first TP
+    first_pair = np.cumsum(counts) - counts
+    time_index = np.arange(counts.sum()) - np.repeat(first_pair - lo, counts)
+    return window_index, time_index
 
 def GetTPLatencies(_tp_received, _tp_requests):
     """
     Matches the received TPs with the TP requests from the TBuffer (triggered by
     the TriggerRecordBuilder), calculates the latency and stores/returns that in
-    a vector of Latency objects.
+    a latency table.
 
     parameters:
-        _tp_received: Vector of TPSetData objects
-        _tp_requests: Vector of TPDataRequest objects
-    """
-
-    latencies = []
-    for request in tqdm(_tp_requests):
-        for tp in _tp_received:
-            # Save latency if within the window
-            if (tp.m_time_start >= request.m_window_begin) and (tp.m_time_start <= request.m_window_end):
-                latency_tptrigger_to_drhandled = (request.m_time_handled - tp.m_time_intrigger)/1e9
-                latency_tptrigger_to_drreceived = (request.m_time_received - tp.m_time_intrigger)/1e9
-                latency_tpbuffered_to_drreceived = (request.m_time_received - tp.m_time_inbuffer)/1e9
-                #print(f"Latency: {latency}")
-                latencies.append(TPLatency(#tp.m_real_time, request.m_real_time,
-                                           latency_tptrigger_to_drhandled,
-                                           latency_tptrigger_to_drreceived,
-                                           latency_tpbuffered_to_drreceived))
-            # If above the window, look at the next request. TPs are sorted...
-            elif tp.m_time_start > request.m_window_end:
-                break
-    return latencies
-
-def GetTP_to_MLT(_trigger_decisions, _tp_requests):
+        _tp_received: TP_RECEIVED_DTYPE table
+        _tp_requests: TP_REQUEST_DTYPE table
+    """
+    order = np.argsort(_tp_received['time_start'], kind='stable')
+    request_index, tp_index = GetWindowMatches(_tp_received['time_start'][order],
+                                               _tp_requests['window_begin'],
+                                               _tp_requests['window_end'])
+    tps = _tp_received[order[tp_index]]
+    requests = _tp_requests[request_index]
+
+    return MakeTable(latency_tptrigger_to_drhandled=GetLatency(requests['time_handled'], tps['time_intrigger']),
+                     latency_tptrigger_to_drreceived=GetLatency(requests['time_received'], tps['time_intrigger']),
+                     latency_tpbuffered_to_drreceived=GetLatency(requests['time_received'], tps['time_inbuffer']))
+
+def GetTP_to_MLT(_trigger_decisions, _tp_received):
     """
     Matches the received TPs with the Trigger Decisions sent from the
     ModuleLevelTrigger, calculates the latency and stores/returns that in a
-    vector of Latency objects.
+    latency table.
 
     parameters:
-        _trigger_decisions: Vector of MLTTriggerDecision objects
-        _tp_requests: Vector of TPDataRequest objects
-    """
-    latencies = []
-    for td in tqdm(_trigger_decisions):
-        for tp in _tp_requests:
-            if (tp.m_time_start >= td.m_readout_start) and (tp.m_time_start <= td.m_readout_end):
-                latency_intrigger_to_tdsent = (td.m_latency_mlt_td_to_dfo - tp.m_time_intrigger )/1e9
-                latency_inbuffer_to_tdsent  = (td.m_latency_mlt_td_to_dfo - tp.m_time_inbuffer  )/1e9
-                latencies.append(TPMLTLatency(latency_intrigger_to_tdsent, latency_inbuffer_to_tdsent))
-            elif tp.m_time_start > td.m_readout_end:
-                break
-    return latencies
-
-def GetMLT_to_DRReceivedLatencies(_trigger_decisions, _data_requests):
-    """
-    Matches the TriggerDecisions from the ModuleLevelTrigger with the
-    DataRequests received by the TPBufer, calculates the latencies and
-    stores/returns that in a vector of Latency objects.
+        _trigger_decisions: TD_SENT_DTYPE table
+        _tp_received: TP_RECEIVED_DTYPE table
+    """
+    order = np.argsort(_tp_received['time_start'], kind='stable')
+    td_index, tp_index = GetWindowMatches(_tp_received['time_start'][order],
+                                          _trigger_decisions['readout_start'],
+                                          _trigger_decisions['readout_end'])
+    tps = _tp_received[order[tp_index]]
+    time_td_sent = _trigger_decisions['time_td_sent'][td_index]
+
+    return MakeTable(latency_tptrigger_to_tdsent=GetLatency(time_td_sent, tps['time_intrigger']),
+                     latency_tpbuffered_to_tdsent=GetLatency(time_td_sent, tps['time_inbuffer']))
+
+def GetTDToDRMatches(_trigger_decisions, _data_requests):
+    """
+    Hash-joins the TriggerDecisions with the DataRequests on their exact
+    (readout_start, readout_end) == (window_begin, window_end) window. The
+    DataRequests are indexed by their window once, so the cost is O(N + M)
+    rather than comparing every pair. One TD can fan out to several DRs.
 
     parameters:
-        _trigger_decisions: Vector of MLTTriggerDecision objects
-        _tp_requests: Vector of DataRequest objects
+        _trigger_decisions: TD_SENT_DTYPE table
+        _data_requests: TP_REQUEST_DTYPE table
+
+    return:
+        (td_index, dr_index) arrays of the matched pairs, followed by the
+        indices of the TDs without a DR and of the DRs without a TD
     """
-    latencies = []
-    for td in tqdm(_trigger_decisions):
-        for dr in _data_requests:
-            if (td.m_readout_start == dr.m_window_begin) and (td.m_readout_end == dr.m_window_end):
-                latency = (dr.m_time_received - td.m_latency_mlt_td_to_dfo)/1e9
-                latencies.append(MLTDRLatency(latency))
-    return latencies
+    requests_by_window = {}
+    for i, window in enumerate(zip(_data_requests['window_begin'].tolist(),
+                                   _data_requests['window_end'].tolist())):
+        requests_by_window.setdefault(window, []).append(i)
 
-def GetNumberFromLine(_line, _text):
+    td_index = []
+    dr_index = []
+    unmatched_td = []
+    dr_matched = np.zeros(len(_data_requests), dtype=bool)
+    for i, window in enumerate(zip(_trigger_decisions['readout_start'].tolist(),
+                                   _trigger_decisions['readout_end'].tolist())):
+        matches = requests_by_window.get(window)
+        if matches is None:
+            unmatched_td.append(i)
+            continue
+        td_index.extend([i]*len(matches))
+        dr_index.extend(matches)
+        dr_matched[matches] = True
+
+    return (np.array(td_index, dtype=np.int64), np.array(dr_index, dtype=np.int64),
+            np.array(unmatched_td, dtype=np.int64), np.flatnonzero(~dr_matched))
+
+# Trigger window of a TD and/or DR. Missing TD or DR times are -1, with
+# td_index/dr_index set to -1. A TD with several DRs (or a DR matching
+# several TDs) appears in several windows, only one of which is primary.
+WINDOW_DTYPE = np.dtype([('window_begin',     np.int64),
+                         ('window_end',       np.int64),
+                         ('time_td_sent',     np.int64),
+                         ('time_dr_received', np.int64),
+                         ('time_dr_handled',  np.int64),
+                         ('td_index',         np.int64),
+                         ('dr_index',         np.int64),
+                         ('td_primary',       np.bool_),
+                         ('dr_primary',       np.bool_)])
+
+# One TP in one trigger window, with the timestamps of every DAQ stage
+TRACE_DTYPE = np.dtype([('time_start',     np.int64),
+                        ('adc_integral',   np.int64),
+                        ('time_intrigger', np.int64),
+                        ('time_inbuffer',  np.int64)] + WINDOW_DTYPE.descr)
+
+def GetPrimary(_index):
+    """
+    Flags the first occurrence of every non-negative index.
+    """
+    primary = _index < 0
+    primary[np.unique(_index, return_index=True)[1]] = True
+    return primary
+
+def TakeRows(_table, _index):
+    """
+    Gets the table rows at the given indices, with zeroed rows for index -1.
+    """
+    rows = np.zeros(len(_index), dtype=_table.dtype)
+    valid = _index >= 0
+    rows[valid] = _table[_index[valid]]
+    return rows
+
+def GetWindowTable(_trigger_decisions, _data_requests):
     """
-    Gets a number from text line of text given the line and the text descriptor that
-    corresponds to that number. E.g. "version_number: 5" will return 5 if
-    provide "version_number:" in line parameter.
+    Outer-joins the TriggerDecisions with the DataRequests on their window,
+    giving one row per matched TD/DR pair, unmatched TD and unmatched DR,
+    sorted by window start.
 
     parameters:
-        _line: whole line of text for parsing to extract specific number
-        _text: number's descriptior. E.g. "timestamp:" for "timestamp: 12132342"
+        _trigger_decisions: TD_SENT_DTYPE table
+        _data_requests: TP_REQUEST_DTYPE table
+
+    return:
+        WINDOW_DTYPE table
+    """
+    td_index, dr_index, unmatched_td, unmatched_dr = GetTDToDRMatches(_trigger_decisions, _data_requests)
+    no_match_td = np.full(len(unmatched_dr), -1, dtype=np.int64)
+    no_match_dr = np.full(len(unmatched_td), -1, dtype=np.int64)
+    td_index = np.concatenate([td_index, unmatched_td, no_match_td])
+    dr_index = np.concatenate([dr_index, no_match_dr, unmatched_dr])
+
+    has_td = td_index >= 0
+    has_dr = dr_index >= 0
+    tds = TakeRows(_trigger_decisions, td_index)
+    drs = TakeRows(_data_requests, dr_index)
+
+    windows = np.empty(len(td_index), dtype=WINDOW_DTYPE)
+    windows['window_begin'] = np.where(has_td, tds['readout_start'], drs['window_begin'])
+    windows['window_end'] = np.where(has_td, tds['readout_end'], drs['window_end'])
+    windows['time_td_sent'] = np.where(has_td, tds['time_td_sent'], -1)
+    windows['time_dr_received'] = np.where(has_dr, drs['time_received'], -1)
+    windows['time_dr_handled'] = np.where(has_dr, drs['time_handled'], -1)
+    windows['td_index'] = td_index
+    windows['dr_index'] = dr_index
+    windows['td_primary'] = GetPrimary(td_index)
+    windows['dr_primary'] = GetPrimary(dr_index)
+    return SortTable(windows, 'window_begin')
+
+def GetTraceTable(_tp_received, _windows):
+    """
+    Builds the end-to-end trace table, with one row per TP per trigger window
+    holding the TP, TD and DR timestamps. The TPs are joined with all the
+    windows in a single GetWindowMatches pass.
+
+    parameters:
+        _tp_received: TP_RECEIVED_DTYPE table, sorted by time_start
+        _windows: WINDOW_DTYPE table
+
+    return:
+        TRACE_DTYPE table
+    """
+    window_index, tp_index = GetWindowMatches(_tp_received['time_start'],
+                                              _windows['window_begin'],
+                                              _windows['window_end'])
+    trace = np.empty(len(tp_index), dtype=TRACE_DTYPE)
+    for column in TP_RECEIVED_DTYPE.names:
+        trace[column] = _tp_received[column][tp_index]
+    for column in WINDOW_DTYPE.names:
+        trace[column] = _windows[column][window_index]
+    return trace
+
+def GetWindowLatencies(_windows):
+    """
+    Calculates the TD sent to DR received latency of every matched window.
+
+    parameters:
+        _windows: WINDOW_DTYPE table
+    """
+    matched = _windows[(_windows['td_index'] >= 0) & (_windows['dr_index'] >= 0)]
+    return MakeTable(latency_td_to_dr=GetLatency(matched['time_dr_received'], matched['time_td_sent']))
+
+def GetTraceLatencies(_trace):
+    """
+    Calculates the TP to TD sent and the TP to DR latencies as column
+    differences of the trace table. Each TD and each DR is only counted in its
+    primary window.
+
+    parameters:
+        _trace: TRACE_DTYPE table
+
+    return:
+        TP to TD latency table, TP to DR latency table
+    """
+    td = _trace[(_trace['td_index'] >= 0) & _trace['td_primary']]
+    dr = _trace[(_trace['dr_index'] >= 0) & _trace['dr_primary']]
+    return (MakeTable(latency_tptrigger_to_tdsent=GetLatency(td['time_td_sent'], td['time_intrigger']),
+                      latency_tpbuffered_to_tdsent=GetLatency(td['time_td_sent'], td['time_inbuffer'])),
+            MakeTable(latency_tptrigger_to_drhandled=GetLatency(dr['time_dr_handled'], dr['time_intrigger']),
+                      latency_tptrigger_to_drreceived=GetLatency(dr['time_dr_received'], dr['time_intrigger']),
+                      latency_tpbuffered_to_drreceived=GetLatency(dr['time_dr_received'], dr['time_inbuffer'])))
+
+def SaveTraceTable(_trace, _file):
+    """
+    Exports the trace table to CSV (.csv) or to a numpy binary file (.npy).
+    """
+    if _file.endswith('.csv'):
+        np.savetxt(_file, _trace, fmt='%d', delimiter=',', header=','.join(_trace.dtype.names), comments='')
+    elif _file.endswith('.npy'):
+        np.save(_file, _trace)
+    else:
+        raise ValueError(f"Unknown trace table format for {_file}, use .csv or .npy")
+    print(f"Saved {len(_trace)} trace rows to {_file}")
+
+# Latency quantiles reported next to every histogram
+QUANTILES = (0.5, 0.9, 0.99)
+
+class LatencyHistogram:
+    """
+    Latency histogram with fixed bin edges. It is filled incrementally, so its
+    cost only depends on the new values, and histograms sharing the same edges
+    can be merged. The counts include an underflow and an overflow bin, like
+    ROOT's TH1.
+    """
+    def __init__(self, _edges):
+        self.m_edges = np.asarray(_edges, dtype=np.float64)
+        self.m_counts = np.zeros(len(self.m_edges) + 1, dtype=np.int64)
+        self.m_sum = 0.
+        self.m_minimum = np.inf
+        self.m_maximum = -np.inf
+
+    @classmethod
+    def Linear(cls, _bins, _minimum, _maximum):
+        """
+        Creates a histogram with equally wide bins between minimum and maximum.
+        """
+        return cls(np.linspace(_minimum, _maximum, _bins + 1))
+
+    @classmethod
+    def Logarithmic(cls, _bins, _minimum, _maximum):
+        """
+        Creates a histogram with bins equally wide in log scale between minimum
+        and maximum, to resolve latencies over many orders of magnitude.
+        """
+        if _minimum <= 0:
+            raise ValueError("Logarithmic bins need a positive minimum")
+        return cls(np.geomspace(_minimum, _maximum, _bins + 1))
+
+    def IsLogarithmic(self):
+        """
+        Whether the bins are equally wide in log scale, to draw them on a log axis.
+        """
+        if len(self.m_edges) < 3 or self.m_edges[0] <= 0:
+            return False
+        ratios = self.m_edges[1:]/self.m_edges[:-1]
+        return bool(np.allclose(ratios, ratios[0]))
+
+    @property
+    def m_entries(self):
+        return int(self.m_counts.sum())
+
+    def Fill(self, _values):
+        """
+        Adds an array of values to the histogram.
+        """
+        if len(_values) == 0:
+            return
+        index = np.searchsorted(self.m_edges, _values, side='right')
+        self.m_counts += np.bincount(index, minlength=len(self.m_counts))
+        self.m_sum += float(np.sum(_values))
+        self.m_minimum = min(self.m_minimum, float(np.min(_values)))
+        self.m_maximum = max(self.m_maximum, float(np.max(_values)))
+
+    def Merge(self, _other):
+        """
+        Adds the contents of another histogram with the same bin edges.
+        """
+        if not np.array_equal(self.m_edges, _other.m_edges):
+            raise ValueError("Only histograms with the same bin edges can be merged")
+        self.m_counts += _other.m_counts
+        self.m_sum += _other.m_sum
+        self.m_minimum = min(self.m_minimum, _other.m_minimum)
+        self.m_maximum = max(self.m_maximum, _other.m_maximum)
+
+    def Quantile(self, _quantile):
+        """
+        Estimates a quantile by linear interpolation inside the bin holding it.
+        The estimate is clamped to the observed minimum and maximum, which also
+        covers the quantiles falling in the underflow or overflow.
+        """
+        cumulative = np.cumsum(self.m_counts)
+        if cumulative[-1] == 0:
+            return np.nan
+        target = _quantile*cumulative[-1]
+        index = int(np.searchsorted(cumulative, target, side='left'))
+        if index == 0:
+            return self.m_minimum
+        if index == len(self.m_counts) - 1:
+            return self.m_maximum
+        below = cumulative[index - 1]
+        fraction = (target - below)/self.m_counts[index] if self.m_counts[index] else 0.
+        low, high = self.m_edges[index - 1], self.m_edges[index]
+        return min(max(low + fraction*(high - low), self.m_minimum), self.m_maximum)
+
+    def GetQuantiles(self):
+        """
+        Same as GetQuantiles, estimated from the histogram.
+        """
+        return [self.Quantile(quantile) for quantile in QUANTILES] + [self.m_maximum]
+
+class IncrementalJoiner:
+    """
+    Joins the TPs, TriggerDecisions and DataRequests appended to a log while it
+    is being written, keeping only the unresolved tail of each in memory.
+
+    A window is joined with the TPs once the latest TP start time is _horizon
+    ticks past its end, and TPs are dropped once they are _horizon ticks older
+    than the latest TP and older than every pending window. The horizon has to
+    cover both the TP arrival disorder and the trigger latency.
+    """
+    def __init__(self, _horizon):
+        self.m_horizon = _horizon
+        self.m_latest_tp = None
+        self.m_tp_received = np.empty(0, dtype=TP_RECEIVED_DTYPE)
+        self.m_td_sent = np.empty(0, dtype=TD_SENT_DTYPE)
+        self.m_tp_requests = np.empty(0, dtype=TP_REQUEST_DTYPE)
+
+        # TD to DR matching: the TD sent and DR received times seen so far for
+        # every pending window, plus the windows in arrival order so they can
+        # be expired oldest first
+        self.m_times_by_window = {}
+        self.m_window_order = deque()
+        self.m_unmatched_td = 0
+        self.m_unmatched_dr = 0
+
+    def GetWindowTimes(self, _window):
+        """
+        Returns the lists of TD sent and DR received times of a window,
+        starting to track the window if it is new.
+        """
+        times = self.m_times_by_window.get(_window)
+        if times is None:
+            times = self.m_times_by_window[_window] = ([], [])
+            self.m_window_order.append(_window)
+        return times
+
+    def MatchTDsToDRs(self, _td_sent, _tp_requests):
+        """
+        Matches the new TDs and DRs with each other and with the pending ones.
+
+        return:
+            array of the TD sent to DR received latencies
+        """
+        latencies = []
+        for window, time_td_sent in zip(zip(_td_sent['readout_start'].tolist(), _td_sent['readout_end'].tolist()),
+                                        _td_sent['time_td_sent'].tolist()):
+            tds, drs = self.GetWindowTimes(window)
+            tds.append(time_td_sent)
+            latencies.extend(GetLatency(time_received, time_td_sent) for time_received in drs)
+
+        for window, time_received in zip(zip(_tp_requests['window_begin'].tolist(), _tp_requests['window_end'].tolist()),
+                                         _tp_requests['time_received'].tolist()):
+            tds, drs = self.GetWindowTimes(window)
+            drs.append(time_received)
+            latencies.extend(GetLatency(time_received, time_td_sent) for time_td_sent in tds)
+        return np.array(latencies, dtype=np.float64)
+
+    def ExpireWindows(self, _cutoff):
+        """
+        Forgets the TD to DR matching state of the windows ending before the
+        cutoff, counting the ones that never found a counterpart.
+        """
+        while self.m_window_order and self.m_window_order[0][1] < _cutoff:
+            tds, drs = self.m_times_by_window.pop(self.m_window_order.popleft())
+            if not drs:
+                self.m_unmatched_td += len(tds)
+            if not tds:
+                self.m_unmatched_dr += len(drs)
+
+    def Update(self, _records, _flush=False):
+        """
+        Adds newly parsed records and joins the windows that can be resolved.
+
+        parameters:
+            _records: dictionary of record name to record table of new records
+            _flush: resolve every pending window, e.g. at the end of the run
+
+        return:
+            list of latency tables of the newly resolved records
+        """
+        tp_received = _records['tp_received']
+        tables = [GetTPReceivedLatencies(tp_received),
+                  GetDRLatencies(_records['tp_requests']),
+                  MakeTable(latency_td_to_dr=self.MatchTDsToDRs(_records['td_sent'], _records['tp_requests']))]
+
+        self.m_tp_received = SortTable(np.concatenate([self.m_tp_received, tp_received]), 'time_start')
+        self.m_td_sent = np.concatenate([self.m_td_sent, _records['td_sent']])
+        self.m_tp_requests = np.concatenate([self.m_tp_requests, _records['tp_requests']])
+        if len(tp_received):
+            latest = int(tp_received['time_start'].max())
+            self.m_latest_tp = latest if self.m_latest_tp is None else max(self.m_latest_tp, latest)
+        if self.m_latest_tp is None and not _flush:
+            return tables
+
+        # Join the windows that all their TPs have arrived for
+        resolved_until = np.iinfo(np.int64).max if _flush else self.m_latest_tp - self.m_horizon
+        resolved_td = self.m_td_sent['readout_end'] <= resolved_until
+        resolved_dr = self.m_tp_requests['window_end'] <= resolved_until
+        tables.append(GetTP_to_MLT(self.m_td_sent[resolved_td], self.m_tp_received))
+        tables.append(GetTPLatencies(self.m_tp_received, self.m_tp_requests[resolved_dr]))
+        self.m_td_sent = self.m_td_sent[~resolved_td]
+        self.m_tp_requests = self.m_tp_requests[~resolved_dr]
+
+        # Only keep the TPs that pending or future windows can still request
+        cutoff = resolved_until
+        if len(self.m_td_sent):
+            cutoff = min(cutoff, int(self.m_td_sent['readout_start'].min()))
+        if len(self.m_tp_requests):
+            cutoff = min(cutoff, int(self.m_tp_requests['window_begin'].min()))
+        self.m_tp_received = self.m_tp_received[self.m_tp_received['time_start'] >= cutoff]
+        self.ExpireWindows(resolved_until)
+        return tables
+
+def FillHistograms(_histograms, _tables):
+    """
+    Fills the latency histograms from the columns of latency tables.
+    """
+    for table in _tables:
+        for column in table.dtype.names:
+            _histograms[column].Fill(table[column])
+
+def GetQuantiles(_values):
+    """
+    Gets the exact latency quantiles of an array of values. np.quantile
+    partitions the values instead of sorting them, so this is O(N).
 
     return:
-        integer number corresponding to it's text descriptor
-    """
-    location = _line.find(_text)
-    ret = _line[location:]
-    ret = ret.replace(_text + " ", "")
-    ret = ret.split(" ")
-    #print("PRESPLIT: ", ret)
-    ret = int(ret[0])
-    #print("POSTSPLIT: ", ret)
-    return int(ret)
-
-def GetObjectVector(_file, _prefix, _token_list, _ObjectType):
-    # Open the file
-    input_file = open(_file)
-    input_data = input_file.readlines()
-    input_file.close()
-
-    # Debugging...
-    print(f'Getting the following objects:\n  _file: {_file}\n  _prefix: {_prefix}\n  _token_list: {_token_list}\n  _ObjectType: {_ObjectType}')
-    
-    objects = []
-    for line in input_data:
-        # Only continue if the prefix is right
-        if(_prefix not in line):
+        list of the QUANTILES values followed by the maximum
+    """
+    return np.quantile(_values, QUANTILES).tolist() + [float(np.max(_values))]
+
+def FormatQuantiles(_quantiles):
+    """
+    Formats the output of GetQuantiles or LatencyHistogram.GetQuantiles.
+    """
+    return ", ".join([f"p{100*quantile:g} {value:.6f} s" for quantile, value in zip(QUANTILES, _quantiles)] +
+                     [f"max {_quantiles[-1]:.6f} s"])
+
+def PrintSummary(_histograms):
+    """
+    Prints the number of entries and the latency quantiles of each histogram.
+    """
+    for column, histogram in _histograms.items():
+        if histogram.m_entries == 0:
             continue
+        print(f"{column}: {histogram.m_entries} entries, mean {histogram.m_sum/histogram.m_entries:.6f} s, "
+              f"{FormatQuantiles(histogram.GetQuantiles())}")
 
-        # Extract the line
-        location = line.find(_prefix)
-        line = (line[location:])
+def Follow(_file, _output, _histogram_edges, _horizon, _interval, _block_size=READ_BLOCK_SIZE, _backend='root'):
+    """
+    Tails a DAQ log while it is being written, joining and histogramming the
+    latencies of the newly appended records only. The summary and the plots are
+    refreshed every _interval seconds until interrupted with Ctrl-C.
 
-        # Fill data for each token
-        data = []
-        for token in _token_list:
-            data.append(GetNumberFromLine(line, token))
+    parameters:
+        _file: uncompressed DAQ log file
+        _output: the plot output prefix
+        _histogram_edges: bin edges of the latency histograms, in seconds
+        _horizon: TP time window kept for joining late windows, in TP ticks
+        _interval: seconds between refreshes
+        _block_size: number of bytes read per block
+        _backend: plotting backend, one of BACKENDS
+    """
+    tail = LogTail(_file, _block_size)
+    joiner = IncrementalJoiner(_horizon)
+    histograms = {column: LatencyHistogram(_histogram_edges) for column in LATENCY_PLOTS}
 
-        # Create the new object and append to our array
-        objects.append(_ObjectType(*data))
+    flush = False
+    while not flush:
+        try:
+            FillHistograms(histograms, joiner.Update(tail.Poll()))
+            time.sleep(_interval)
+        except KeyboardInterrupt:
+            flush = True
+            FillHistograms(histograms, joiner.Update(tail.Poll(), _flush=True))
 
-    # Return array of objects
-    return objects
+        print(f"\n{time.strftime('%H:%M:%S')} {_file}: {len(joiner.m_tp_received)} TPs, "
+              f"{len(joiner.m_td_sent)} TDs and {len(joiner.m_tp_requests)} DRs pending, "
+              f"{joiner.m_unmatched_td} TDs without DR, {joiner.m_unmatched_dr} DRs without TD")
+        PrintSummary(histograms)
+        for column, histogram in histograms.items():
+            if histogram.m_entries:
+                PlotHistogram(histogram, _output + LATENCY_PLOTS[column][0], LATENCY_PLOTS[column][1], _backend)
 
 def SetStyle():
     """
@@ -249,137 +661,459 @@ def SetStyle():
    
     ROOT.gROOT.SetStyle("Default");
 
-def DrawAndSave(histogram, name):
+def GetROOT():
+    """
+    Imports ROOT on first use, in batch mode and with the plotting style set.
+    """
+    global ROOT
+    if ROOT is None:
+        import ROOT as root
+        ROOT = root
+        ROOT.gROOT.SetBatch(True)
+        # Sets the general stylistics (based on NOvA)
+        SetStyle()
+    return ROOT
+
+def DrawAndSave(histogram, name, logx=False):
     # Save the histograms
     canvas = ROOT.TCanvas("canvas")
     canvas.cd()
+    canvas.SetLogx(logx)
     histogram.Draw()
     canvas.SaveAs(name)
 
-def Plot(_vector_objects, _data_handle_name, _output_name, _histogram_title):
+def Plot(_table, _column, _output_name, _histogram_title, _bins=100, _backend='root'):
     """
-    Plots a vector of objects' data member into a histogram and saves it into an
-    output .png file.
+    Plots a column of a record/latency table into a histogram and saves it into
+    an output .png file. The range and the bin contents are computed with numpy
+    over the whole column, without sorting it.
 
     prameters:
-        _vector_objects: vector of objects for plotting
-        _data_handle_name: the exact name of the object's class data member to plot
+        _table: numpy structured array for plotting
+        _column: the exact name of the table's column to plot
         _output_name: the full output name
         _histogram_title: histogram title with the axis titles, in ROOT format
+        _bins: number of histogram bins
+        _backend: plotting backend, one of BACKENDS
     """
-    # Sets the general stylistics (based on NOvA)
-    SetStyle()
-    ROOT.gROOT.SetBatch(True)
+    values = _table[_column]
+    if len(values) == 0:
+        print(f"No {_column} values to plot")
+        return
 
-    # Sort the latencies and find min/max
-    print("Sorting received TPs!")
-    _vector_objects.sort(key=lambda x: vars(x)[_data_handle_name])
-    minimum = vars(_vector_objects[0])[_data_handle_name]
-    maximum = vars(_vector_objects[-1])[_data_handle_name]
+    quantiles = GetQuantiles(values)
+    minimum = float(values.min())
+    maximum = quantiles[-1]
 
     print(f"Minimum: {minimum}")
     print(f"Maximum: {maximum}")
+    print(f"{_column}: {FormatQuantiles(quantiles)}")
 
-    # Create and fill the latencies histogram
-    histogram= ROOT.TH1D("", _histogram_title, 100, float(minimum), float(maximum))
-    for obj in _vector_objects:
-        histogram.Fill(vars(obj)[_data_handle_name])
+    # Create and fill the latencies histogram. Bins include their lower edge
+    # only, so the upper edge is padded to keep the maximum out of the
+    # overflow, and a single repeated value gets a range around it.
+    if maximum > minimum:
+        maximum = float(np.nextafter(maximum, np.inf))
+    else:
+        half_width = 0.5*(abs(minimum) or 1.)
+        minimum, maximum = minimum - half_width, maximum + half_width
+    histogram = LatencyHistogram.Linear(_bins, minimum, maximum)
+    histogram.Fill(values)
+    PlotHistogram(histogram, _output_name, _histogram_title, _backend)
 
-    DrawAndSave(histogram, _output_name)
-
-def main(_file, _output):
-    # Extracting Data Requests
-    print("Extracting the DataRequest objects")
+def PlotLatency(_table, _column, _output, _backend='root'):
+    """
+    Plots a latency column with its standard output name and title.
 
-    tp_requests = GetObjectVector(_file, 'TPs Requested:',
-                                  ['window_begin:', 'window_end:', 'real_time_req:', 'real_time_han:'],
-                                  TPDataRequest)
+    parameters:
+        _table: latency table
+        _column: latency column name in LATENCY_PLOTS
+        _output: the plot output prefix
+        _backend: plotting backend, one of BACKENDS
+    """
+    Plot(_table, _column, _output + LATENCY_PLOTS[_column][0], LATENCY_PLOTS[_column][1], _backend=_backend)
 
-    #tp_requests = GetTPDataRequests(_file)
+def PlotHistogram(_histogram, _output_name, _histogram_title, _backend='root'):
+    """
+    Draws an already filled LatencyHistogram and saves it into an output .png
+    file. With the 'none' backend the bin contents are written to a .txt file
+    of the same name instead.
 
-    print("Plotting the DataRequest latency")
-    Plot(tp_requests, 
-         "m_latency_dr_received_to_handled",
-         _output + "latency_DRReceived_to_DRHandled.png",
-         "Latency: DataRequest Received to DataRequest handled;#Delta t(s);Number of TPs")
+    parameters:
+        _histogram: LatencyHistogram to draw
+        _output_name: the full output name
+        _histogram_title: histogram title with the axis titles, in ROOT format
+        _backend: plotting backend, one of BACKENDS
+    """
+    if _backend == 'root':
+        DrawAndSaveROOT(_histogram, _output_name, _histogram_title)
+    elif _backend == 'mpl':
+        DrawAndSaveMpl(_histogram, _output_name, _histogram_title)
+    elif _backend == 'none':
+        SaveHistogramText(_histogram, os.path.splitext(_output_name)[0] + '.txt', _histogram_title)
+    else:
+        raise ValueError(f"Unknown plotting backend {_backend}, use one of {BACKENDS}")
 
-    # Extracting ModuleLevelTrigger TriggerDecisions
-    print("Extracting the MLTTriggerDecision objects")
+def DrawAndSaveROOT(_histogram, _output_name, _histogram_title):
+    """
+    Draws a LatencyHistogram as a ROOT TH1D.
+    """
+    GetROOT()
+    edges = _histogram.m_edges
+    histogram = ROOT.TH1D("", _histogram_title, len(edges) - 1, array('d', edges))
+    # Bin 0 and the last bin are the under- and overflow, as in ROOT
+    for i, count in enumerate(_histogram.m_counts.tolist()):
+        histogram.SetBinContent(i, count)
+    histogram.SetEntries(_histogram.m_entries)
 
-    td_sent = GetObjectVector(_file, 'MLT TD Sent:',
-                              ['readout_start:', 'readout_end:', 'time_td_sent:'],
-                              MLTTriggerDecision)
+    DrawAndSave(histogram, _output_name, _histogram.IsLogarithmic())
 
+def DrawAndSaveMpl(_histogram, _output_name, _histogram_title):
+    """
+    Draws a LatencyHistogram with matplotlib, without needing a display.
+    """
+    from matplotlib.figure import Figure
 
-    #td_sent = GetMLTTriggerDecisions(_file)
-    print("Sorting MLTTriggerDecision objects")
-    td_sent.sort(key=lambda x: x.m_readout_start)
+    # ROOT titles are "title;x axis;y axis", with TLatex greek letters
+    title, xlabel, ylabel = (_histogram_title.replace('#Delta', r'$\Delta$').split(';') + ['', ''])[:3]
+    figure = Figure()
+    axes = figure.subplots()
+    axes.stairs(_histogram.m_counts[1:-1], _histogram.m_edges)
+    if _histogram.IsLogarithmic():
+        axes.set_xscale('log')
+    axes.set_title(title)
+    axes.set_xlabel(xlabel)
+    axes.set_ylabel(ylabel)
+    figure.savefig(_output_name)
+    print(f"Saved {_output_name}")
 
-    # Extracting the received and buffered TPSets
-    print("Extracting the received TPs")
-    tp_received = GetObjectVector(_file, 'TPs Received.',
-                                  ['time_start:', 'ADC integral:', 'real_time_in:', 'real_time_buff:'],
-                                  TPSetData)
+def SaveHistogramText(_histogram, _output_name, _histogram_title):
+    """
+    Writes the bin edges and contents of a LatencyHistogram to a text file.
+    """
+    header = (f"{_histogram_title}\nunderflow: {_histogram.m_counts[0]} overflow: {_histogram.m_counts[-1]}\n"
+              "bin_low bin_high count")
+    np.savetxt(_output_name,
+               np.column_stack([_histogram.m_edges[:-1], _histogram.m_edges[1:], _histogram.m_counts[1:-1]]),
+               fmt=['%.9g', '%.9g', '%d'], header=header)
+    print(f"Saved {_output_name}")
 
-    #tp_received = GetTPSets(_file)
+def GetLatencyTables(_records, _trace_output=None, _profiler=NO_PROFILER):
+    """
+    Joins the parsed log records and computes all the latency tables.
 
-    print("Plotting the TP objects")
-    Plot(tp_received, 
-         "m_latency_tp_received_to_buffered",
-         _output + "latency_TPReceived_to_TPBuffered.png",
-         "Latency: TPSet Received to TPSet buffered;#Delta t(s);Number of TPs")
+    parameters:
+        _records: dictionary of record name to record table, from ParseLog
+        _trace_output: optional file to export the per-TP trace table to
+        _profiler: StageProfiler measuring the sort, join, write and latencies stages
 
-    print("Sorting TP requests!")
-    tp_requests.sort(key=lambda x: x.m_window_begin)
+    return:
+        dictionary of each LATENCY_PLOTS column to a latency table holding it
+    """
+    tp_requests = _records['tp_requests']
+    td_sent = _records['td_sent']
+    tp_received = _records['tp_received']
 
     print("Sorting received TPs!")
-    tp_received.sort(key=lambda x: x.m_time_start)
-
-    # Extrating the TriggerDecisions from the ModuleLevelTrigger
-    print("Filling the MLT Trigger decisions to DataRequestes received latencies!")
-    mlt_to_drreceived_latencies = GetMLT_to_DRReceivedLatencies(td_sent, tp_requests)
-    Plot(mlt_to_drreceived_latencies, 
-         "m_latency_td_to_dr",
-         _output + "latency_TriggerDecision_to_DRReceived.png",
-         "Latency: MLT Trigger Decision Sent to DataRequest Received;#Delta t(s);Number of DataRequests")
-
-    print("Filling the TPReceived & buffered to MLT trigger decision sent!")
-    tp_to_mlt_latencues = GetTP_to_MLT(td_sent, tp_received)
-
-    # Plotting the rest of the latencies
-    Plot(tp_to_mlt_latencues, 
-         "m_latency_tptrigger_to_tdsent",
-         _output + "latency_TPReceived_to_TDSent.png",
-         "Latency: TPSet Received to MLT Trigger Decision Sent;#Delta t(s);Number of TPs")
-
-    Plot(tp_to_mlt_latencues, 
-         "m_latency_tpbuffered_to_tdsent",
-         _output + "latency_TPBuffered_to_TDSent.png",
-         "Latency: TPSet Buffered to MLT Trigger Decision Sent;#Delta t(s);Number of TPs")
-
-    print("Filling the TP latencies!")
-    latencies = GetTPLatencies(tp_received, tp_requests)
-    Plot(latencies, 
-         "m_latency_tptrigger_to_drhandled",
-         _output + "latency_TPReceived_to_DRHandled.png",
-         "Latency: TPSet Received to DataRequest Handled;#Delta t(s);Number of TPs")
-    Plot(latencies, 
-         "m_latency_tptrigger_to_drreceived",
-         _output + "latency_TPReceived_to_DRReceived.png",
-         "Latency: TPSet Received to DataRequest Received;#Delta t(s);Number of TPs")
-    Plot(latencies, 
-         "m_latency_tpbuffered_to_drreceived",
-         _output + "latency_TPBuffered_to_DRReceived.png",
-         "Latency: TPSet Buffered to DataRequest Received;#Delta t(s);Number of TPs")
-    
+    with _profiler.stage("sort", len(tp_received)) as stage:
+        tp_received = SortTable(tp_received, 'time_start')
+        stage.records_out = len(tp_received)
+
+    # Matching the TriggerDecisions from the ModuleLevelTrigger to the DataRequests
+    with _profiler.stage("join", len(tp_received) + len(td_sent) + len(tp_requests)) as stage:
+        print("Matching the MLT Trigger decisions to the DataRequests!")
+        windows = GetWindowTable(td_sent, tp_requests)
+        print(f"TriggerDecisions without a DataRequest: {np.count_nonzero(windows['dr_index'] < 0)} / {len(td_sent)}")
+        print(f"DataRequests without a TriggerDecision: {np.count_nonzero(windows['td_index'] < 0)} / "
+              f"{len(tp_requests)}")
+
+        print("Building the TP trace table!")
+        trace = GetTraceTable(tp_received, windows)
+        stage.records_out = len(trace)
+    if _trace_output:
+        with _profiler.stage("write trace", len(trace)) as stage:
+            SaveTraceTable(trace, _trace_output)
+            stage.records_out = len(trace)
+
+    with _profiler.stage("latencies", len(trace) + len(windows) + len(tp_received)) as stage:
+        tp_to_mlt_latencies, tp_to_dr_latencies = GetTraceLatencies(trace)
+        tables = {'latency_dr_received_to_handled':  GetDRLatencies(tp_requests),
+                  'latency_tp_received_to_buffered': GetTPReceivedLatencies(_records['tp_received']),
+                  'latency_td_to_dr':                GetWindowLatencies(windows)}
+        for table in (tp_to_mlt_latencies, tp_to_dr_latencies):
+            tables.update({column: table for column in table.dtype.names})
+        stage.records_out = sum(len(tables[column]) for column in LATENCY_PLOTS)
+    return tables
+
+def ReadRecords(_file, _block_size=READ_BLOCK_SIZE, _cache_dir=CACHE_DIR, _cache_size=CACHE_SIZE, _jobs=1):
+    """
+    Extracts all the records in one streaming pass over the log, or from the
+    cache of a previous run.
+    """
+    print(f"Extracting the DataRequest, MLTTriggerDecision and received TP records from {_file}")
+    if _cache_dir:
+        return ParseLogCached(_file, _cache_dir, _cache_size, _block_size, _jobs)
+    return ParseLog(_file, _block_size, _jobs)
+
+def main(_file, _output, _block_size=READ_BLOCK_SIZE, _cache_dir=CACHE_DIR, _cache_size=CACHE_SIZE, _jobs=1,
+         _trace_output=None, _backend='root', _profile_output=None, _cprofile_output=None):
+    profiler = StageProfiler(_profile_output is not None, _cprofile_output is not None)
+    # The log is read and parsed in one streaming pass, so they are one stage
+    with profiler.stage("read and parse") as stage:
+        records = ReadRecords(_file, _block_size, _cache_dir, _cache_size, _jobs)
+        stage.records_out = sum(len(table) for table in records.values())
+    tables = GetLatencyTables(records, _trace_output, profiler)
+
+    print("Plotting the latencies")
+    with profiler.stage("histogram and plot", sum(len(tables[column]) for column in LATENCY_PLOTS)) as stage:
+        for column in LATENCY_PLOTS:
+            PlotLatency(tables[column], column, _output, _backend)
+        stage.records_out = len(LATENCY_PLOTS)
+
+    if _profile_output:
+        profiler.save(_profile_output, _cprofile_output, script="daq_trigger_latencies", file=_file,
+                      jobs=_jobs, backend=_backend)
+
+def GetRunNames(_files):
+    """
+    Names every run after its log file, without the directory and the
+    extensions. Logs sharing a name in different directories get as many
+    parent directories prepended as needed to tell them apart, and the names
+    still shared, e.g. by a log given twice, get an index.
+    """
+    stems = [os.path.basename(file).split('.')[0] for file in _files]
+    directories = [os.path.dirname(os.path.abspath(file)).split(os.sep) for file in _files]
+    prefixes = {}
+    for stem in set(stems):
+        group = {tuple(directory) for directory, other in zip(directories, stems) if other == stem}
+        depth = 0
+        while len({directory[max(len(directory) - depth, 0):] for directory in group}) < len(group):
+            depth += 1
+        for directory in group:
+            prefixes[stem, directory] = [part for part in directory[max(len(directory) - depth, 0):] if part]
+
+    runs = ["_".join(prefixes[stem, tuple(directory)] + [stem]) for stem, directory in zip(stems, directories)]
+    counts = Counter(runs)
+    seen = Counter()
+    for i, run in enumerate(runs):
+        if counts[run] > 1:
+            seen[run] += 1
+            runs[i] = f"{run}_{seen[run]}"
+    return runs
+
+def ProcessRun(_file, _histogram_edges, _block_size=READ_BLOCK_SIZE, _cache_dir=CACHE_DIR, _cache_size=CACHE_SIZE):
+    """
+    Batch worker: computes the latencies of one log, and histograms them on the
+    shared bin edges so the runs can be merged. Only the histograms and the
+    exact quantiles are sent back to the parent process.
+
+    return:
+        dictionary of column to LatencyHistogram, dictionary of column to the
+        GetQuantiles output (None without entries)
+    """
+    tables = GetLatencyTables(ReadRecords(_file, _block_size, _cache_dir, _cache_size))
+    histograms = {column: LatencyHistogram(_histogram_edges) for column in LATENCY_PLOTS}
+    quantiles = {}
+    for column in LATENCY_PLOTS:
+        values = tables[column][column]
+        histograms[column].Fill(values)
+        quantiles[column] = GetQuantiles(values) if len(values) else None
+    return histograms, quantiles
+
+def SaveRunSummary(_runs, _results, _output_name):
+    """
+    Writes the entries, mean and exact quantiles of every latency of every run to a csv file.
+    """
+    with open(_output_name, 'w') as output:
+        output.write(",".join(['run', 'latency', 'entries', 'mean'] + [f"p{100*quantile:g}" for quantile in QUANTILES] +
+                              ['max']) + "\n")
+        for run, (histograms, quantiles) in zip(_runs, _results):
+            for column, histogram in histograms.items():
+                if quantiles[column] is None:
+                    continue
+                output.write(",".join([run, column, str(histogram.m_entries),
+                                       f"{histogram.m_sum/histogram.m_entries:.9g}"] +
+                                      [f"{value:.9g}" for value in quantiles[column]]) + "\n")
+    print(f"Saved {_output_name}")
+
+def Batch(_files, _output, _histogram_edges, _jobs=1, _block_size=READ_BLOCK_SIZE, _cache_dir=CACHE_DIR,
+          _cache_size=CACHE_SIZE, _backend='root', _per_run_plots=False, _profile_output=None, _cprofile_output=None):
+    """
+    Processes many DAQ logs in a pool of _jobs processes. Each run is
+    histogrammed on the same fixed, by default log-spaced, bin edges, so the combined distributions are
+    plain merges of the per-run histograms. Plotting happens in the parent
+    process only, so ROOT is started once.
+
+    parameters:
+        _files: DAQ log files, optionally compressed
+        _output: the plot output prefix
+        _histogram_edges: bin edges of the latency histograms, in seconds
+        _jobs: number of runs processed in parallel
+        _block_size: number of bytes read per block
+        _cache_dir: parsed log cache directory, None to disable the cache
+        _cache_size: cache size limit in bytes
+        _backend: plotting backend, one of BACKENDS
+        _per_run_plots: also plot every latency of every run
+        _profile_output: optional JSON file to write the per-stage profile to
+        _cprofile_output: optional file to dump the cProfile statistics of the slowest stage to
+    """
+    profiler = StageProfiler(_profile_output is not None, _cprofile_output is not None)
+    runs = GetRunNames(_files)
+    n = len(_files)
+    # The runs are read, parsed, joined and histogrammed in the workers, so they are one stage here
+    with profiler.stage("process runs", n) as stage:
+        with ProcessPoolExecutor(max_workers=_jobs) as pool:
+            results = list(pool.map(ProcessRun, _files, [_histogram_edges]*n, [_block_size]*n, [_cache_dir]*n,
+                                    [_cache_size]*n))
+        stage.records_out = sum(histogram.m_entries for histograms, _ in results for histogram in histograms.values())
+
+    with profiler.stage("merge", n) as stage:
+        combined = {column: LatencyHistogram(_histogram_edges) for column in LATENCY_PLOTS}
+        for run, (histograms, _) in zip(runs, results):
+            print(f"\n{run}:")
+            PrintSummary(histograms)
+            for column, histogram in histograms.items():
+                combined[column].Merge(histogram)
+                if _per_run_plots and histogram.m_entries:
+                    PlotHistogram(histogram, _output + run + "_" + LATENCY_PLOTS[column][0],
+                                  LATENCY_PLOTS[column][1], _backend)
+        print(f"\nCombined over {n} runs:")
+        PrintSummary(combined)
+        SaveRunSummary(runs, results, _output + "latency_runs.csv")
+        stage.records_out = len(combined)
+
+    with profiler.stage("plot", len(combined)) as stage:
+        for column, histogram in combined.items():
+            if histogram.m_entries == 0:
+                continue
+            file_name, title = LATENCY_PLOTS[column]
+            PlotHistogram(histogram, _output + "combined_" + file_name, title, _backend)
+            quantiles = np.array([quantiles[column] if quantiles[column] is not None
+                                  else [np.nan]*(len(QUANTILES) + 1) for _, quantiles in results])
+            PlotComparison(runs, quantiles, _output + "runs_" + file_name, title, _backend)
+        stage.records_out = len(combined)
+
+    if _profile_output:
+        profiler.save(_profile_output, _cprofile_output, script="daq_trigger_latencies", files=list(_files),
+                      jobs=_jobs, backend=_backend)
+
+def PlotComparison(_runs, _quantiles, _output_name, _histogram_title, _backend='root'):
+    """
+    Draws the latency quantiles of every run side by side, to compare the runs.
+    With the 'none' backend they are written to a .txt file instead.
+
+    parameters:
+        _runs: run names
+        _quantiles: (runs, QUANTILES + max) array of latency quantiles in seconds
+        _output_name: the full output name
+        _histogram_title: title of the latency histogram, in ROOT format
+        _backend: plotting backend, one of BACKENDS
+    """
+    title = _histogram_title.split(';')[0] + " per run;Run;#Delta t(s)"
+    labels = [f"p{100*quantile:g}" for quantile in QUANTILES] + ['max']
+    if _backend == 'root':
+        GetROOT()
+        canvas = ROOT.TCanvas("canvas")
+        canvas.cd()
+        legend = ROOT.TLegend(0.8, 0.7, 0.95, 0.9)
+        graphs = []
+        for i, label in enumerate(labels):
+            graph = ROOT.TH1D("", title, len(_runs), 0, len(_runs))
+            for run_index, run in enumerate(_runs):
+                graph.GetXaxis().SetBinLabel(run_index + 1, run)
+                graph.SetBinContent(run_index + 1, _quantiles[run_index, i])
+            graph.SetMarkerStyle(20)
+            graph.SetMarkerColor(i + 1)
+            graph.SetMaximum(1.1*np.nanmax(_quantiles))
+            graph.SetMinimum(0)
+            graph.Draw("P" if i == 0 else "P SAME")
+            legend.AddEntry(graph, label, "p")
+            graphs.append(graph)
+        legend.Draw()
+        canvas.SaveAs(_output_name)
+    elif _backend == 'mpl':
+        from matplotlib.figure import Figure
+
+        title, xlabel, ylabel = title.replace('#Delta', r'$\Delta$').split(';')
+        figure = Figure(figsize=(max(6.4, 0.3*len(_runs)), 4.8), layout='constrained')
+        axes = figure.subplots()
+        for i, label in enumerate(labels):
+            axes.plot(np.arange(len(_runs)), _quantiles[:, i], 'o', label=label)
+        axes.set_xticks(np.arange(len(_runs)), _runs, rotation=90)
+        axes.set_title(title)
+        axes.set_xlabel(xlabel)
+        axes.set_ylabel(ylabel)
+        axes.legend()
+        figure.savefig(_output_name)
+        print(f"Saved {_output_name}")
+    elif _backend == 'none':
+        output_name = os.path.splitext(_output_name)[0] + '.txt'
+        with open(output_name, 'w') as output:
+            output.write(f"# {title}\n# run {' '.join(labels)}\n")
+            for run, quantiles in zip(_runs, _quantiles):
+                output.write(run + " " + " ".join(f"{value:.9g}" for value in quantiles) + "\n")
+        print(f"Saved {output_name}")
+    else:
+        raise ValueError(f"Unknown plotting backend {_backend}, use one of {BACKENDS}")
+
 if __name__ == "__main__":
     import argparse
 
     parser = argparse.ArgumentParser(description="Sterilize DAQ log to get the latency timestamps")
 
     # TODO: Add user-defined minimum and maximum?
-    parser.add_argument('-f' '--file',   dest='file',     help='DAQ log file input')
+    parser.add_argument('-f' '--file',   dest='file',     help='DAQ log file input, optionally .gz/.xz/.zst compressed')
     parser.add_argument('-o' '--output', dest='output',   default='', help='Plot output')
+    parser.add_argument('--block-size',  dest='block_size', type=int, default=READ_BLOCK_SIZE//(1024*1024),
+                        help='Size of the blocks the log is streamed in, in MB')
+    parser.add_argument('--cache-dir',   dest='cache_dir', default=CACHE_DIR,
+                        help='Directory caching the parsed records of previously read logs')
+    parser.add_argument('--cache-size',  dest='cache_size', type=int, default=CACHE_SIZE//(1024*1024),
+                        help='Size limit of the cache directory in MB, least recently used logs are evicted first')
+    parser.add_argument('--no-cache',    dest='cache_dir', action='store_const', const=None,
+                        help='Always parse the log, without reading or writing the cache')
+    parser.add_argument('-j', '--jobs',  dest='jobs', type=int, default=1,
+                        help='Number of processes parsing an uncompressed log, or processing the --batch logs,'
+                             ' in parallel')
+
+    parser.add_argument('--trace',       dest='trace', default=None,
+                        help='Export the per-TP trace table of all DAQ stage timestamps (.csv or .npy)')
+    parser.add_argument('--backend',     dest='backend', choices=BACKENDS, default='root',
+                        help="Plotting backend: ROOT, matplotlib, or 'none' to only write the histogram contents")
+    parser.add_argument('--follow',      dest='follow', action='store_true',
+                        help='Keep tailing a growing log and refresh the latencies until interrupted')
+    parser.add_argument('--interval',    dest='interval', type=float, default=10.,
+                        help='Seconds between refreshes in --follow mode')
+    parser.add_argument('--horizon',     dest='horizon', type=int, default=625000000,
+                        help='TP time window kept in --follow mode to join late trigger windows, in TP ticks')
+    parser.add_argument('--batch',       dest='batch', nargs='+', default=None,
+                        help='Process many DAQ logs, given as files or quoted glob patterns, in -j processes and'
+                             ' plot the combined latencies and a comparison of the runs')
+    parser.add_argument('--per-run-plots', dest='per_run_plots', action='store_true',
+                        help='Also plot every latency of every run in --batch mode')
+    parser.add_argument('--latency-range', dest='latency_range', type=float, nargs=2, default=[1e-6, 1e2],
+                        help='Latency histogram range in --follow and --batch mode, in seconds')
+    parser.add_argument('--bins',        dest='bins', type=int, default=400,
+                        help='Number of latency histogram bins in --follow and --batch mode')
+    parser.add_argument('--linear-bins', dest='linear_bins', action='store_true',
+                        help='Use equally wide latency bins in --follow and --batch mode, instead of log-spaced ones')
+    parser.add_argument('--profile',     dest='profile', default=None,
+                        help='Write the wall time, CPU time, peak RSS and throughput of every stage to this JSON file')
+    parser.add_argument('--cprofile',    dest='cprofile', default=None,
+                        help='With --profile, also dump the cProfile statistics of the slowest stage to this file')
 
     args = parser.parse_args()
-    main(args.file, args.output)
+    binning = LatencyHistogram.Linear if args.linear_bins else LatencyHistogram.Logarithmic
+    if args.batch:
+        files = [file for pattern in args.batch for file in (sorted(glob.glob(pattern)) or [pattern])]
+        Batch(files, args.output, binning(args.bins, *args.latency_range).m_edges, args.jobs,
+              args.block_size*1024*1024, args.cache_dir, args.cache_size*1024*1024, args.backend, args.per_run_plots,
+              args.profile, args.cprofile)
+    elif args.follow:
+        if args.file.endswith(COMPRESSED_SUFFIXES):
+            parser.error("--follow needs the uncompressed log being written, not " + args.file)
+        Follow(args.file, args.output, binning(args.bins, *args.latency_range).m_edges,
+               args.horizon, args.interval, args.block_size*1024*1024, args.backend)
+    else:
+        main(args.file, args.output, args.block_size*1024*1024, args.cache_dir, args.cache_size*1024*1024,
+             args.jobs, args.trace, args.backend, args.profile, args.cprofile)
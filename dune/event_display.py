@@ -0,0 +1,103 @@
+# Event displays of TPs on the time vs offline channel plane. Small windows are
+# drawn TP by TP as a scatter; anything larger is binned onto a fixed time x
+# channel grid weighted by the ADC sum and drawn as an image, so the render time
+# and memory do not grow with the number of TPs.
+from matplotlib import colors
+import numpy as np
+from tp_io import DATASET_COLUMNS, TICK_PERIOD_NS
+
+DISPLAYS = ("auto", "raster", "scatter")
+
+# Largest number of TPs drawn as a scatter in the auto display
+SCATTER_MAX_TPS = 100000
+
+# Default raster size. The channel axis gets one bin per channel up to this many.
+RASTER_TIME_BINS = 2000
+RASTER_CHANNEL_BINS = 2000
+
+# Number of TPs binned at a time, bounding the temporaries for memory mapped inputs
+RASTER_CHUNK_ROWS = 1 << 20
+
+
+def get_range(values):
+    """
+    Smallest and largest value of an integer column, as python ints.
+    """
+    return int(values.min()), int(values.max())
+
+
+def raster_tps(rows, time_bins=RASTER_TIME_BINS, channel_bins=RASTER_CHANNEL_BINS, time_range=None,
+               channel_range=None, columns=DATASET_COLUMNS, chunk_rows=RASTER_CHUNK_ROWS):
+    """
+    Bin TPs onto a time x channel grid, summing the ADC integrals in each bin.
+    The bin indices are computed in int64 ticks, so the raw timestamps never go
+    through float64, and the TPs are binned chunk by chunk.
+    :param rows: (rows, columns) int64 array of TPs, possibly memory mapped.
+    :param time_bins: Number of time bins.
+    :param channel_bins: Maximum number of channel bins.
+    :param time_range: Inclusive (first, last) start time in ticks, the TP range if None.
+    :param channel_range: Inclusive (first, last) channel, the TP range if None.
+    :param columns: Column names of rows.
+    :param chunk_rows: Number of TPs binned at a time.
+    :return: (time_bins, channel bins) float64 image, time edges in ticks, channel edges
+    """
+    time_column = columns.index("start_time")
+    channel_column = columns.index("channel")
+    adc_column = columns.index("adc_integral")
+    if time_range is None:
+        time_range = get_range(rows[:, time_column])
+    if channel_range is None:
+        channel_range = get_range(rows[:, channel_column])
+    time_span = time_range[1] - time_range[0] + 1
+    channel_span = channel_range[1] - channel_range[0] + 1
+    time_bins = min(time_bins, time_span)
+    channel_bins = min(channel_bins, channel_span)
+
+    image = np.zeros(time_bins*channel_bins)
+    for begin in range(0, len(rows), chunk_rows):
+        chunk = rows[begin:begin + chunk_rows]
+        times = chunk[:, time_column] - time_range[0]
+        channels = chunk[:, channel_column] - channel_range[0]
+        inside = (times >= 0) & (times < time_span) & (channels >= 0) & (channels < channel_span)
+        time_index = times[inside]*time_bins//time_span
+        channel_index = channels[inside]*channel_bins//channel_span
+        image += np.bincount(time_index*channel_bins + channel_index, weights=chunk[inside, adc_column],
+                             minlength=len(image))
+
+    time_edges = time_range[0] + np.arange(time_bins + 1)*time_span/time_bins
+    channel_edges = channel_range[0] + np.arange(channel_bins + 1)*channel_span/channel_bins
+    return image.reshape(time_bins, channel_bins), time_edges, channel_edges
+
+
+def draw_event_display(ax, rows, time_shift=0, label=None, display="auto", time_bins=RASTER_TIME_BINS,
+                       channel_bins=RASTER_CHANNEL_BINS, columns=DATASET_COLUMNS):
+    """
+    Draw an event display of TPs on a matplotlib axis, with the time in seconds
+    relative to time_shift.
+    :param ax: Matplotlib axis.
+    :param rows: (rows, columns) int64 array of TPs, possibly memory mapped.
+    :param time_shift: Start time in ticks drawn as zero.
+    :param label: Label of the drawn artist, shown in the legend for the scatter.
+    :param display: "scatter", "raster", or "auto" to scatter only up to SCATTER_MAX_TPS TPs.
+    :param time_bins: Number of raster time bins.
+    :param channel_bins: Maximum number of raster channel bins.
+    :param columns: Column names of rows.
+    :return: the scatter or image artist, None if there are no TPs
+    """
+    if len(rows) == 0:
+        return None
+    tick = TICK_PERIOD_NS*1e-9
+    if display == "scatter" or (display == "auto" and len(rows) <= SCATTER_MAX_TPS):
+        start_time_seconds = (rows[:, columns.index("start_time")] - time_shift)*tick
+        adc_sum = rows[:, columns.index("adc_integral")]
+        return ax.scatter(start_time_seconds, rows[:, columns.index("channel")], s=1, label=label, c=adc_sum,
+                          vmax=np.max(adc_sum)/10)
+
+    image, time_edges, channel_edges = raster_tps(rows, time_bins, channel_bins, columns=columns)
+    # Empty bins are left blank rather than drawn at the bottom of the log colour scale
+    image = np.ma.masked_equal(image, 0)
+    extent = ((time_edges[0] - time_shift)*tick, (time_edges[-1] - time_shift)*tick, channel_edges[0], channel_edges[-1])
+    artist = ax.imshow(image.T, origin="lower", aspect="auto", extent=extent, interpolation="nearest",
+                       norm=colors.LogNorm(), label=label)
+    ax.figure.colorbar(artist, ax=ax, label="ADC sum per bin")
+    return artist
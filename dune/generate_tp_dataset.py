@@ -2,41 +2,210 @@
 # since the TPStream files are quite blocky, and don't guarantee a continuous time ordered
 # representation of the TPs seen by the trigger system in online runs. The output can be
 # fed directly to the TP replay app in DUNE DAQ, for offline triggering studies.
+from concurrent.futures import ProcessPoolExecutor
 from matplotlib import pyplot as plt
+from matplotlib.collections import PathCollection
 import numpy as np
 import argparse
+import os
+from tp_io import read_tp_file, read_tp_dataset, write_tp_text, write_tp_binary, iter_time_ordered_tps, \
+    get_tp_index, get_tp_columns, read_tp_window, format_tp_rows, TPTextWriter, TPBinaryWriter, TP_COLUMNS, \
+    DATASET_COLUMNS, DATASET_ORDER, WRITE_BLOCK_ROWS
+from event_display import draw_event_display, DISPLAYS
+from profiling import StageProfiler, NO_PROFILER
 
 
 # Check the time ordering of a list of times.
 def check_time_ordering(list):
-    ordered = True
     print("Checking TP time ordering...")
-    previous = 0
-    for start_time in list:
-        if start_time < previous:
-            ordered = False
-        previous = start_time
-    return ordered
+    return bool(np.all(np.diff(list) >= 0))
 
 
-def read_data_file(file):
+def read_data_file(file, profiler=NO_PROFILER):
     """
     Read in the data file of trigger primitives, order them
     by start time, as we expect the trigger system to see them.
     Return the ordered data set for dataset making.
     :param file: Input TPs extracted from TPStream file.
-    :return: data - numpy array representing the full input file, time ordered
+    :param profiler: StageProfiler measuring the read and sort stages.
+    :return: data - int64 numpy array representing the full input file, time ordered
     """
     print("Grabbing TP info from input file.")
-    data = np.genfromtxt(file, delimiter=' ')
-    if not check_time_ordering(data[:, 0]):
-        print("Input is not time ordered. This is kind of expected, ordering now...")
-        data = data[data[:, 0].argsort()]
+    with profiler.stage("read") as stage:
+        data = read_tp_file(file)
+        stage.records_out = len(data)
+    with profiler.stage("sort", len(data)) as stage:
+        if not check_time_ordering(data[:, 0]):
+            print("Input is not time ordered. This is kind of expected, ordering now...")
+            data = data[data[:, 0].argsort(kind='stable')]
+        stage.records_out = len(data)
     data = data.transpose()
     return data
 
 
-def construct_dataset(data, out, num_seconds):
+def select_dataset(blocks, num_tps, num_seconds):
+    """
+    Turn time ordered blocks of TPs into blocks of dataset lines: the first
+    num_tps TPs within num_seconds of the first TP, with the times shifted to
+    start at zero and the columns in the replay app order. Stops consuming the
+    blocks as soon as the dataset is complete.
+    :param blocks: Iterable of time ordered (rows, TP columns) int64 arrays.
+    :param num_tps: The maximum number of TPs in the dataset.
+    :param num_seconds: The number of seconds we'll attempt to extract from the input.
+    :return: generator of (rows, dataset columns) int64 arrays
+    """
+    time_shift = None
+    remaining = num_tps
+    for block in blocks:
+        block = block[:remaining]
+        if len(block) == 0:
+            break
+        if time_shift is None:
+            time_shift = block[0, 0]
+        # Also get the times in seconds, more understandable for us making a dataset.
+        start_time_seconds = (block[:, 0] - time_shift)*16e-9
+        # The TPs are time ordered, so everything before the first TP past num_seconds goes in.
+        num_in_time = np.searchsorted(start_time_seconds, num_seconds, side='left')
+
+        dataset = block[:num_in_time, DATASET_ORDER]
+        dataset[:, DATASET_COLUMNS.index("start_time")] -= time_shift
+        dataset[:, DATASET_COLUMNS.index("time_peak")] -= time_shift
+        yield dataset
+
+        remaining -= num_in_time
+        if num_in_time < len(block) or remaining == 0:
+            break
+
+
+def parse_channel_ranges(text):
+    """
+    Parse shard channel ranges: comma separated half open begin:end ranges,
+    where begin:end:width splits [begin, end) into consecutive ranges of width
+    channels, e.g. "0:30720:2560" for 12 links of 2560 channels.
+    :return: list of (begin, end) channel ranges, ordered by begin
+    """
+    ranges = []
+    for item in text.split(","):
+        values = [int(value) for value in item.split(":")]
+        if len(values) == 3:
+            begin, end, width = values
+            ranges += [(edge, min(edge + width, end)) for edge in range(begin, end, width)]
+        else:
+            ranges.append(tuple(values))
+    ranges.sort()
+    for (_, end), (begin, _) in zip(ranges[:-1], ranges[1:]):
+        if begin < end:
+            raise ValueError("Overlapping shard channel ranges in " + text)
+    return ranges
+
+
+def get_shard_files(out, ranges):
+    """
+    Name the shard files after the output file and their channel ranges.
+    """
+    root, extension = os.path.splitext(out)
+    return [root + "_ch" + str(begin) + "-" + str(end - 1) + extension for begin, end in ranges]
+
+
+def partition_shards(block, ranges):
+    """
+    Split a block of dataset TPs by channel range with one stable argsort on
+    the shard index, so each shard keeps the time order of the block. TPs
+    outside all the ranges are dropped.
+    :param block: Time ordered (rows, dataset columns) int64 array.
+    :param ranges: Ordered, non overlapping (begin, end) channel ranges.
+    :return: list of the TPs of each shard, number of TPs outside all the ranges
+    """
+    channels = block[:, DATASET_COLUMNS.index("channel")]
+    begins = np.array([begin for begin, _ in ranges])
+    ends = np.array([end for _, end in ranges])
+    shard = np.searchsorted(begins, channels, side='right') - 1
+    shard[(shard >= 0) & (channels >= ends[shard])] = -1
+    counts = np.bincount(shard + 1, minlength=len(ranges) + 1)
+    parts = np.split(block[np.argsort(shard, kind='stable')], np.cumsum(counts)[:-1])
+    return parts[1:], counts[0]
+
+
+def write_pieces(pieces, pool):
+    """
+    Write (writer, rows) pieces in order. Text pieces are formatted by the
+    worker pool when there is one, the writing itself stays in this process so
+    every file is appended to in order.
+    """
+    if pool is None or isinstance(pieces[0][0], TPBinaryWriter):
+        for writer, rows in pieces:
+            writer.write(rows)
+        return
+    texts = pool.map(format_tp_rows, [rows for _, rows in pieces])
+    for (writer, rows), text in zip(pieces, texts):
+        writer.write_text(text, len(rows))
+
+
+def write_sharded_dataset(out, blocks, ranges, binary=False, run="", jobs=1, merged=False):
+    """
+    Write the selected dataset blocks into one file per channel range in a
+    single pass, optionally also writing the time ordered merged dataset of all
+    the shards to out. Only the text formatting runs in a pool of jobs
+    processes; every file is written serially by this process, and binary
+    shards, which need no formatting, ignore jobs.
+    :param out: The name of the merged output file, the shard files are named after it.
+    :param blocks: Iterable of time ordered (rows, dataset columns) int64 arrays.
+    :param ranges: Ordered, non overlapping (begin, end) channel ranges.
+    :param binary: Write the binary TP dataset format instead of text.
+    :param run: The run number stored in the binary header.
+    :param jobs: Number of processes formatting the text output, ignored for binary shards.
+    :param merged: Also write the merged dataset to out.
+    :return: number of TPs written
+    """
+    files = get_shard_files(out, ranges) + ([out] if merged else [])
+    writers = [TPBinaryWriter(file, DATASET_COLUMNS, run) if binary else TPTextWriter(file) for file in files]
+    if binary and jobs > 1:
+        print("Binary shards need no formatting, writing them serially and ignoring -j.")
+        jobs = 1
+    pool = ProcessPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    dropped = 0
+    try:
+        for block in blocks:
+            parts, num_dropped = partition_shards(block, ranges)
+            dropped += num_dropped
+            if merged:
+                parts.append(np.concatenate(parts))
+                parts[-1] = parts[-1][parts[-1][:, 0].argsort(kind='stable')]
+            pieces = [(writer, part[begin:begin + WRITE_BLOCK_ROWS]) for writer, part in zip(writers, parts)
+                      for begin in range(0, len(part), WRITE_BLOCK_ROWS)]
+            # Bound the number of formatted blocks held at once
+            for begin in range(0, len(pieces), 4*jobs):
+                write_pieces(pieces[begin:begin + 4*jobs], pool)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+        for writer in writers:
+            writer.close()
+
+    for file, writer in zip(files, writers):
+        print("Wrote ", writer.num_rows, " TPs to ", file)
+    if dropped:
+        print("Dropped ", dropped, " TPs outside the shard channel ranges.")
+    return sum(writer.num_rows for writer in writers[:len(ranges)])
+
+
+def write_dataset(out, blocks, binary=False, run="", shards=None, jobs=1, merged=False):
+    """
+    Write the selected dataset blocks either as replay app text or in the
+    compact binary TP dataset format, into one file or one file per channel range.
+    :param shards: (begin, end) channel ranges to shard the dataset by, None for a single file.
+    :param jobs: Number of processes formatting the sharded text output.
+    :param merged: Also write the merged dataset to out when sharding.
+    :return: number of TPs written
+    """
+    if shards:
+        return write_sharded_dataset(out, blocks, shards, binary, run, jobs, merged)
+    if binary:
+        return write_tp_binary(out, blocks, DATASET_COLUMNS, run)
+    return write_tp_text(out, blocks)
+
+
+def construct_dataset(data, out, num_seconds, binary=False, run="", profiler=NO_PROFILER, **shard_options):
     """
     This part does the heavy lifting, writing each TP as one line
     to the output file. The format is displayed below, what the replay
@@ -44,63 +213,113 @@ def construct_dataset(data, out, num_seconds):
     :param data: The time ordered numpy array read in from the input file.
     :param out: The name of the output file.
     :param num_seconds: The number of seconds we'll attempt to extract from the input.
+    :param binary: Write the binary TP dataset format instead of text.
+    :param run: The run number stored in the binary header.
+    :param profiler: StageProfiler measuring the write stage.
+    :param shard_options: shards, jobs and merged options of write_dataset.
     :return:
     """
     print("Reading in ", n, " TPs...")
-    start_time = data[0][:n]
-    time_shift = start_time[0]
-    start_time = start_time - time_shift
-    time_over = data[1][:n]
-    time_peak = data[2][:n] - time_shift
-    channel = data[3][:n]
-    adc_sum = data[4][:n]
-    adc_peak = data[5][:n]
-    type = data[6][:n]
-    det_id = data[7][:n]
-    # Also get the times in seconds, more understandable for us making a dataset.
-    start_time_seconds = start_time*16e-9
-
     print("Attempting to write ", num_seconds, " seconds of TP dataset for offline trigger use. The output is in the"
           + " following format, which can be fed directly to the trigger replay app:\n"
           "<start_time> <time_over_threshold> <time_peak> <channel> <adc_integral> <adc_peak> <det_id> <type>")
-    f = open(out, 'w')
-    for i, st in enumerate(start_time_seconds):
-        if st < num_seconds:
-            info = str(int(start_time[i])) + " " + str(int(time_over[i])) + " " + str(int(time_peak[i])) +\
-                   " " + str(int(channel[i])) + " " + str(int(adc_sum[i])) + " " + str(int(adc_peak[i])) +\
-                   " " + str(int(det_id[i])) + " " + str(int(type[i])) + "\n"
-            f.write(info)
-    f.close()
+    with profiler.stage("select and write", n) as stage:
+        stage.records_out = write_dataset(out, select_dataset([data.transpose()], n, num_seconds), binary, run,
+                                          **shard_options)
+
+
+def construct_dataset_stream(file, out, num_seconds, binary=False, run="", profiler=NO_PROFILER, **shard_options):
+    """
+    Same as construct_dataset, but sorting the input with a bounded-memory
+    external merge sort instead of loading it all, for full-run TPStream dumps.
+    The whole input is still read once and spilled as int64 sorted runs to a
+    temporary directory, which needs free space of about the input size; only
+    the merge stops as soon as the dataset is complete.
+    :param file: Input TPs extracted from TPStream file.
+    :param out: The name of the output file.
+    :param num_seconds: The number of seconds we'll attempt to extract from the input.
+    :param binary: Write the binary TP dataset format instead of text.
+    :param run: The run number stored in the binary header.
+    :param profiler: StageProfiler measuring the streaming stage. Reading, sorting and
+        writing are interleaved, so they are measured as one stage.
+    :param shard_options: shards, jobs and merged options of write_dataset.
+    :return:
+    """
+    print("Streaming up to ", n, " time ordered TPs...")
+    with profiler.stage("read, sort and write") as stage:
+        written = write_dataset(out, select_dataset(iter_time_ordered_tps(file), n, num_seconds), binary, run,
+                                **shard_options)
+        stage.records_out = written
+    print("Wrote ", written, " TPs.")
+
+
+def construct_dataset_window(file, out, start, duration, binary=False, run="", profiler=NO_PROFILER,
+                             **shard_options):
+    """
+    Cut the window [start, start + duration) seconds out of the run, using the
+    sidecar time-block index to read only the blocks overlapping it. The index
+    is built on the first use, after which cutting many windows from a long run
+    costs I/O proportional to the window size.
+    :param file: Input TPs extracted from TPStream file, or a binary TP dataset.
+    :param out: The name of the output file.
+    :param start: Start of the window in seconds, relative to the first TP of the input.
+    :param duration: Length of the window in seconds.
+    :param binary: Write the binary TP dataset format instead of text.
+    :param run: The run number stored in the binary header.
+    :param profiler: StageProfiler measuring the index, read and write stages.
+    :param shard_options: shards, jobs and merged options of write_dataset.
+    :return:
+    """
+    with profiler.stage("index") as stage:
+        index = get_tp_index(file)
+        stage.records_out = int(index["rows"].sum())
+    if len(index) == 0:
+        print("No TPs in the input file.")
+        return
+    time_begin = index["time_min"].min() + int(round(start/16e-9))
+    time_end = time_begin + int(round(duration/16e-9))
+    print("Extracting ", duration, " seconds of TPs starting ", start, " seconds into the input...")
+    with profiler.stage("read window") as stage:
+        window = read_tp_window(file, time_begin, time_end, index)
+        # Bring binary dataset inputs back to the TPStream column order
+        columns = get_tp_columns(file)
+        window = window[:, [columns.index(column) for column in TP_COLUMNS]]
+        stage.records_out = len(window)
+    with profiler.stage("select and write", len(window)) as stage:
+        written = write_dataset(out, select_dataset([window], len(window), duration), binary, run, **shard_options)
+        stage.records_out = written
+    print("Wrote ", written, " TPs.")
 
 
-def plot_constructed_dataset(out, run):
+def plot_constructed_dataset(out, run, display="auto"):
     """
     Read in the constructed file clean, and plot the results.
     Aim here is to help user see that the constructed dataset looks
     as expected before feeding to the replay app / analysing.
-    :param out: The output dataset we have constructed in this script.
+    :param out: The output dataset we have constructed in this script, text or binary.
     :param run: The run number, read from the input arguments to this script.
+    :param display: Event display type, "scatter", "raster" or "auto" to pick by the number of TPs.
     :return:
     """
-    data = np.genfromtxt(out, delimiter=' ')
-    data = data.transpose()
-    start_time_seconds = data[0][:]*16e-9
-    channel = data[3][:]
-    adc_sum = data[4][:n]
+    data = read_tp_dataset(out)
+    if len(data) == 0:
+        print("The constructed dataset is empty, nothing to plot.")
+        return
     # Plot the thing.
     fig = plt.subplot(111)
     title= "VDCB Run " + str(run) + ": 12 Links SW TPG TPs"
     legend_properties = {'weight': 'bold'}
     print("Plotting and saving a event display of extracted TPs dataset.")
     label="Input TPs - Event Display"
-    fig.scatter(start_time_seconds, channel, s=1, label=label, c=adc_sum, vmax=np.max(adc_sum)/10)
+    artist = draw_event_display(fig, data, label=label, display=display)
     fig.set_xlabel("Relative Time (s)", fontweight='bold')
     fig.set_ylabel("Offline Channel ID", fontweight='bold')
     fig.set_title(title, fontweight='bold')
-    fig.legend(prop=legend_properties, loc="upper right")
+    if isinstance(artist, PathCollection):
+        fig.legend(prop=legend_properties, loc="upper right")
     file_name = "run_" + str(run) + "_tp_event_display.png"
     plt.savefig(file_name, format="png")
-    print("Managed to get about ", round(start_time_seconds[-1] - start_time_seconds[0], 1), " seconds of TP stream.")
+    print("Managed to get about ", round((data[-1, 0] - data[0, 0])*16e-9, 1), " seconds of TP stream.")
 
 
 if __name__ == '__main__':
@@ -115,6 +334,32 @@ if __name__ == '__main__':
                         help='Number of TPs from online run to obtain. Default is to try 5 seconds.')
     parser.add_argument('-p', '--plot_output', action="store_true",
                         help="Add this flag to output a png event display of the constructed dataset")
+    parser.add_argument('--display', choices=DISPLAYS, default="auto",
+                        help="Event display type: a scatter of every TP, an ADC sum weighted time x channel raster,"
+                             + " or auto to scatter only small datasets")
+    parser.add_argument('--stream', action="store_true",
+                        help="Time order the input with a bounded-memory external merge sort instead of loading it."
+                             + " Needs temporary disk space of about the input size")
+    parser.add_argument('--start', dest='start', type=float, default=None,
+                        help="Extract the window starting this many seconds into the input, using a sidecar"
+                             + " time-block index. Ignores -n; uses -s as the duration unless --duration is given.")
+    parser.add_argument('--duration', dest='duration', type=float, default=None,
+                        help="Length of the --start window in seconds. Defaults to the -s value.")
+    parser.add_argument('-b', '--binary', action="store_true",
+                        help="Write the compact binary TP dataset format. Convert back to text for the replay app with"
+                             + " 'python tp_io.py to-text'")
+    parser.add_argument('--shards', dest='shards', default=None,
+                        help="Write one dataset per channel range, e.g. '0:2560,2560:5120', or '0:30720:2560' for"
+                             + " consecutive ranges of 2560 channels. The shard files are named after -o.")
+    parser.add_argument('--merged', action="store_true",
+                        help="With --shards, also write the merged dataset of all the shards to -o")
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help="Number of processes formatting the --shards text output. The files themselves are"
+                             + " written serially, and binary shards ignore it")
+    parser.add_argument('--profile', dest='profile', default=None,
+                        help="Write the wall time, CPU time, peak RSS and throughput of every stage to this JSON file")
+    parser.add_argument('--cprofile', dest='cprofile', default=None,
+                        help="With --profile, also dump the cProfile statistics of the slowest stage to this file")
 
     args = parser.parse_args()
     run = args.run
@@ -123,15 +368,30 @@ if __name__ == '__main__':
     n = int(args.num_tps)
     plot_ds = args.plot_output
     num_seconds = int(args.num_secs)
+    shard_options = {"shards": parse_channel_ranges(args.shards) if args.shards else None, "jobs": args.jobs,
+                     "merged": args.merged}
+    profiler = StageProfiler(args.profile is not None, args.cprofile is not None)
 
-    data = read_data_file(file)
-    # Quick check that we have enough TPs in the input. Revert to default otherwise.
-    if len(data[0][:]) < int(n):
-        print("Requested to read more TPs that we have infile, reverting to total TPs.")
-        n = len(data[0][:])
+    if args.start is not None:
+        duration = args.duration if args.duration is not None else num_seconds
+        construct_dataset_window(file, out, args.start, duration, args.binary, run, profiler, **shard_options)
+    elif args.stream:
+        construct_dataset_stream(file, out, num_seconds, args.binary, run, profiler, **shard_options)
+    else:
+        data = read_data_file(file, profiler)
+        # Quick check that we have enough TPs in the input. Revert to default otherwise.
+        if len(data[0][:]) < int(n):
+            print("Requested to read more TPs that we have infile, reverting to total TPs.")
+            n = len(data[0][:])
 
-    construct_dataset(data, out, num_seconds)
-    if plot_ds:
-        plot_constructed_dataset(out, run)
+        construct_dataset(data, out, num_seconds, args.binary, run, profiler, **shard_options)
+    if plot_ds and args.shards and not args.merged:
+        print("Not plotting, there is no merged dataset without --merged.")
+    elif plot_ds:
+        with profiler.stage("plot"):
+            plot_constructed_dataset(out, run, args.display)
+    if args.profile:
+        profiler.save(args.profile, args.cprofile, script="generate_tp_dataset", file=file, out=out,
+                      binary=args.binary, shards=args.shards, jobs=args.jobs)
     print("\nOffline TP dataset complete!\n")
 
@@ -1,61 +1,235 @@
+# Compare an offline TP dataset with the TPs in the windows triggered on it by the
+# replay app: which dataset TPs were captured, the capture fraction per channel
+# and per time bin, and the high ADC clusters the trigger missed.
 from matplotlib import pyplot as plt
 import numpy as np
 import argparse
+from tp_io import read_tp_dataset, DATASET_COLUMNS
+from event_display import draw_event_display, DISPLAYS
 
+TIME_COLUMN = DATASET_COLUMNS.index("start_time")
+CHANNEL_COLUMN = DATASET_COLUMNS.index("channel")
+ADC_COLUMN = DATASET_COLUMNS.index("adc_integral")
 
-# Setup plot
-fig, axs = plt.subplots(2, 1, sharey=True, sharex=True)
-axs.ravel()
-title= "Offline Triggered TPs - VDCB Run 020427: 12 Links SW TPG TPs"
-legend_properties = {'weight': 'bold'}
+CLUSTER_DTYPE = np.dtype([("time_begin", "<i8"), ("time_end", "<i8"), ("channel_min", "<i8"),
+                          ("channel_max", "<i8"), ("num_tps", "<i8"), ("adc_sum", "<i8")])
 
-# Read in offline dataset
-data = np.genfromtxt("../data/tps/offline_tp_datasets/run_020472_tps_2seconds.txt", delimiter=' ')
-data = data.transpose()
 
-start_time = data[0][:]
-time_shift = start_time[0]
-data_channel = data[3][:]
-adc_sum = data[4][:]
-start_time = start_time - time_shift
-start_time *= 16e-9
+def pack_keys(times, channels, time_min, channel_min, num_channels):
+    """
+    Pack (start_time, channel) pairs into single int64 keys ordered by time,
+    then channel, so the pairs can be joined with one sort and a binary search.
+    """
+    return (times - time_min)*num_channels + (channels - channel_min)
 
-triggered_tps = np.genfromtxt("../data/tps/triggered_tps/run_020472_triggered_tp_windows.txt", delimiter=' ')
-triggered_tps = triggered_tps.transpose()
 
-trig_start_time = triggered_tps[0][:]
-# trig_shift = trig_start_time[0]
-trig_start_time = trig_start_time - time_shift
-trig_start_time *= 16e-9
-trig_channel = triggered_tps[3][:]
+def match_captured(data, triggered):
+    """
+    Flag the dataset TPs that appear in the triggered TPs, with a sorted join
+    on (start_time, channel).
+    :param data: (rows, dataset columns) int64 array of the dataset TPs.
+    :param triggered: (rows, dataset columns) int64 array of the triggered TPs.
+    :return: boolean array, True for the captured dataset TPs
+    """
+    if len(data) == 0 or len(triggered) == 0:
+        return np.zeros(len(data), dtype=bool)
+    times = np.concatenate((data[:, TIME_COLUMN], triggered[:, TIME_COLUMN]))
+    channels = np.concatenate((data[:, CHANNEL_COLUMN], triggered[:, CHANNEL_COLUMN]))
+    time_min, time_max = int(times.min()), int(times.max())
+    channel_min, channel_max = int(channels.min()), int(channels.max())
+    num_channels = channel_max - channel_min + 1
+    if (time_max - time_min + 1)*num_channels >= 2**63:
+        raise ValueError("The (start_time, channel) range is too large to pack into int64 keys")
 
-channels = [data_channel, trig_channel]
-times = [start_time, trig_start_time]
-labels = ["Dataset", "Triggered TPs"]
+    keys = pack_keys(data[:, TIME_COLUMN], data[:, CHANNEL_COLUMN], time_min, channel_min, num_channels)
+    triggered_keys = np.sort(pack_keys(triggered[:, TIME_COLUMN], triggered[:, CHANNEL_COLUMN], time_min,
+                                       channel_min, num_channels))
+    found = np.searchsorted(triggered_keys, keys)
+    return triggered_keys[np.minimum(found, len(triggered_keys) - 1)] == keys
 
-for i in range(2):
-    axs[i].scatter(times[i], channels[i], s =2, label=labels[i])
-    # axs[i].legend()
-    if i == 0:
-        axs[i].scatter(times[i+1], channels[i+1], s=5, label=labels[i+1], color='r')
 
-fig.suptitle("Dataset TPs vs Triggered TPs", fontweight="bold", fontsize=20)
-# fig.set_xlabel("Relative Time - Seconds")
-# fig.set_ylabel("Offline Channel ID")
-plt.show()
+def get_capture_fractions(index, captured, num_bins):
+    """
+    Fraction of captured TPs in each bin.
+    :param index: Bin index of each dataset TP.
+    :param captured: Captured flag of each dataset TP.
+    :param num_bins: Number of bins.
+    :return: number of TPs, number captured and the captured fraction (nan for empty bins) per bin
+    """
+    total = np.bincount(index, minlength=num_bins)
+    num_captured = np.bincount(index[captured], minlength=num_bins)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        fraction = num_captured/total
+    return total, num_captured, fraction
 
 
+def find_missed_clusters(data, captured, adc_threshold, cluster_time, cluster_channels):
+    """
+    Group the missed TPs above an ADC threshold into clusters: TPs less than
+    cluster_time ticks apart form a time group, which is split wherever the
+    next channel is more than cluster_channels away.
+    :param data: (rows, dataset columns) int64 array of the dataset TPs, time ordered.
+    :param captured: Captured flag of each dataset TP.
+    :param adc_threshold: Smallest ADC integral of the missed TPs considered.
+    :param cluster_time: Largest start time gap within a cluster, in ticks.
+    :param cluster_channels: Largest channel gap within a cluster.
+    :return: CLUSTER_DTYPE array, largest ADC sum first
+    """
+    missed = data[~captured & (data[:, ADC_COLUMN] >= adc_threshold)]
+    if len(missed) == 0:
+        return np.empty(0, dtype=CLUSTER_DTYPE)
+    missed = missed[missed[:, TIME_COLUMN].argsort(kind='stable')]
+    time_group = np.concatenate(([0], np.cumsum(np.diff(missed[:, TIME_COLUMN]) > cluster_time)))
+    order = np.lexsort((missed[:, CHANNEL_COLUMN], time_group))
+    missed = missed[order]
+    time_group = time_group[order]
+    new_cluster = np.concatenate(([True], (np.diff(time_group) != 0)
+                                  | (np.diff(missed[:, CHANNEL_COLUMN]) > cluster_channels)))
+    begins = np.flatnonzero(new_cluster)
 
+    clusters = np.empty(len(begins), dtype=CLUSTER_DTYPE)
+    clusters["time_begin"] = np.minimum.reduceat(missed[:, TIME_COLUMN], begins)
+    clusters["time_end"] = np.maximum.reduceat(missed[:, TIME_COLUMN], begins)
+    clusters["channel_min"] = missed[begins, CHANNEL_COLUMN]
+    clusters["channel_max"] = np.maximum.reduceat(missed[:, CHANNEL_COLUMN], begins)
+    clusters["num_tps"] = np.diff(np.append(begins, len(missed)))
+    clusters["adc_sum"] = np.add.reduceat(missed[:, ADC_COLUMN], begins)
+    return clusters[np.argsort(-clusters["adc_sum"], kind='stable')]
 
 
+def save_fractions(file, bin_name, bins, total, num_captured, fraction):
+    """
+    Save per-bin capture fractions as a csv file.
+    """
+    table = np.column_stack((bins, total, num_captured, np.nan_to_num(fraction, nan=-1)))
+    np.savetxt(file, table, fmt=["%.9g", "%d", "%d", "%.6f"], delimiter=",",
+               header=bin_name + ",num_tps,num_captured,capture_fraction (-1 for no TPs)", comments="")
 
-# print("Plotting and saving a event display of TPs.")
-# label="Input TPs - Event Display"
-# im = fig.scatter(start_time, channel, s=20, label=label, c=adc_sum, vmax=np.max(adc_sum)/20)
-# fig.set_xlabel("Relative Time (s)", fontweight='bold')
-# fig.set_ylabel("Offline Channel ID", fontweight='bold')
-# fig.set_title(title, fontweight='bold')
-# fig.legend(prop=legend_properties, loc="upper right")
-# file_name = "../output/run_" + str(run) + "_tp_event_display.png"
-# plt.savefig(file_name, format="png")
-# plt.show()
\ No newline at end of file
+
+def print_report(data, captured, channels, channel_fraction, clusters, time_shift, top):
+    """
+    Print the overall capture, the worst captured channels and the largest missed clusters.
+    """
+    total_adc = data[:, ADC_COLUMN].sum()
+    print("Captured ", captured.sum(), " of ", len(data), " dataset TPs (",
+          round(100*captured.mean(), 2), "%), ", round(100*data[captured, ADC_COLUMN].sum()/max(total_adc, 1), 2),
+          "% of the ADC sum.")
+    has_tps = ~np.isnan(channel_fraction)
+    worst = np.argsort(channel_fraction[has_tps], kind='stable')[:top]
+    print("\nLowest capture channels:\n  channel  capture_fraction")
+    for channel, fraction in zip(channels[has_tps][worst], channel_fraction[has_tps][worst]):
+        print("  ", channel, "  ", round(fraction, 4))
+    print("\nLargest missed high ADC clusters (", len(clusters), " in total):")
+    print("  time_begin(s)  time_end(s)  channel_min  channel_max  num_tps  adc_sum")
+    for cluster in clusters[:top]:
+        print("  ", round((cluster["time_begin"] - time_shift)*16e-9, 6), " ",
+              round((cluster["time_end"] - time_shift)*16e-9, 6), " ", cluster["channel_min"], " ",
+              cluster["channel_max"], " ", cluster["num_tps"], " ", cluster["adc_sum"])
+
+
+def plot_capture(channels, channel_fraction, time_bins, time_fraction, file_name):
+    """
+    Plot the capture fraction per channel and per time bin.
+    """
+    fig, axs = plt.subplots(2, 1, figsize=(10, 8))
+    axs[0].step(channels, channel_fraction, where='mid')
+    axs[0].set_xlabel("Offline Channel ID", fontweight='bold')
+    axs[0].set_ylabel("Capture Fraction", fontweight='bold')
+    axs[1].step(time_bins, time_fraction, where='mid')
+    axs[1].set_xlabel("Relative Time (s)", fontweight='bold')
+    axs[1].set_ylabel("Capture Fraction", fontweight='bold')
+    fig.suptitle("Dataset TPs Captured in Triggered Windows", fontweight="bold")
+    fig.savefig(file_name, format="png")
+    plt.close(fig)
+
+
+def plot_overlay(data, triggered, time_shift, display, file_name):
+    """
+    Dataset TPs with the triggered TPs on top, and the triggered TPs alone.
+    """
+    fig, axs = plt.subplots(2, 1, sharey=True, sharex=True)
+    # The full dataset is drawn as an ADC sum raster unless it is small, the triggered TPs on top of it
+    draw_event_display(axs[0], data, time_shift, label="Dataset", display=display)
+    trig_start_time = (triggered[:, TIME_COLUMN] - time_shift)*16e-9
+    axs[0].scatter(trig_start_time, triggered[:, CHANNEL_COLUMN], s=5, label="Triggered TPs", color='r')
+    axs[1].scatter(trig_start_time, triggered[:, CHANNEL_COLUMN], s=2, label="Triggered TPs")
+    axs[1].set_xlabel("Relative Time (s)", fontweight='bold')
+    for ax in axs:
+        ax.set_ylabel("Offline Channel ID", fontweight='bold')
+    fig.suptitle("Dataset TPs vs Triggered TPs", fontweight="bold", fontsize=20)
+    fig.savefig(file_name, format="png")
+    plt.close(fig)
+
+
+def main(dataset, triggered_file, output, time_bin, adc_threshold, cluster_time, cluster_channels, top, display,
+         plot):
+    data = read_tp_dataset(dataset)
+    data = data[data[:, TIME_COLUMN].argsort(kind='stable')]
+    triggered = read_tp_dataset(triggered_file)
+    print("Read ", len(data), " dataset TPs and ", len(triggered), " triggered TPs.")
+    if len(data) == 0:
+        print("The dataset is empty, nothing to compare.")
+        return
+    time_shift = data[0, TIME_COLUMN]
+
+    captured = match_captured(data, triggered)
+
+    channel_min = data[:, CHANNEL_COLUMN].min()
+    channels = np.arange(channel_min, data[:, CHANNEL_COLUMN].max() + 1)
+    channel_total, channel_captured, channel_fraction = get_capture_fractions(
+        data[:, CHANNEL_COLUMN] - channel_min, captured, len(channels))
+    time_index = (data[:, TIME_COLUMN] - time_shift)//max(int(round(time_bin/16e-9)), 1)
+    time_bins = (np.arange(time_index[-1] + 1) + 0.5)*time_bin
+    time_total, time_captured, time_fraction = get_capture_fractions(time_index, captured, len(time_bins))
+
+    if adc_threshold is None:
+        adc_threshold = np.quantile(data[:, ADC_COLUMN], 0.99)
+        print("Using the 99th percentile dataset ADC integral, ", adc_threshold, ", as the missed cluster threshold.")
+    clusters = find_missed_clusters(data, captured, adc_threshold, int(round(cluster_time/16e-9)), cluster_channels)
+
+    print_report(data, captured, channels, channel_fraction, clusters, time_shift, top)
+
+    save_fractions(output + "_per_channel.csv", "channel", channels, channel_total, channel_captured,
+                   channel_fraction)
+    save_fractions(output + "_per_time_bin.csv", "time_bin_centre_s", time_bins, time_total, time_captured,
+                   time_fraction)
+    missed = np.column_stack(((clusters["time_begin"] - time_shift)*16e-9, (clusters["time_end"] - time_shift)*16e-9,
+                              clusters["channel_min"], clusters["channel_max"], clusters["num_tps"],
+                              clusters["adc_sum"]))
+    np.savetxt(output + "_missed_clusters.csv", missed, fmt=["%.9f", "%.9f", "%d", "%d", "%d", "%d"],
+               delimiter=",", header=",".join(("time_begin_s", "time_end_s") + CLUSTER_DTYPE.names[2:]), comments="")
+    print("\nSaved the capture fractions and missed clusters to " + output + "_*.csv")
+
+    if plot:
+        plot_capture(channels, channel_fraction, time_bins, time_fraction, output + "_capture.png")
+        plot_overlay(data, triggered, time_shift, display, output + "_event_display.png")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Match an offline TP dataset to the TPs of the windows triggered on it, and report the trigger"
+                    + " capture efficiency")
+    parser.add_argument('-d', '--dataset', dest='dataset', required=True,
+                        help='Offline TP dataset fed to the replay app, text or binary')
+    parser.add_argument('-t', '--triggered', dest='triggered', required=True,
+                        help='TPs in the triggered windows, in the dataset format')
+    parser.add_argument('-o', '--output', dest='output', default="dataset_vs_triggered",
+                        help='Prefix of the output csv and png files')
+    parser.add_argument('--time-bin', dest='time_bin', type=float, default=0.01,
+                        help='Width of the capture fraction time bins in seconds')
+    parser.add_argument('--adc-threshold', dest='adc_threshold', type=float, default=None,
+                        help='Smallest ADC integral of the missed TPs clustered. Defaults to the 99th percentile')
+    parser.add_argument('--cluster-time', dest='cluster_time', type=float, default=1e-5,
+                        help='Largest time gap within a missed cluster in seconds')
+    parser.add_argument('--cluster-channels', dest='cluster_channels', type=int, default=2,
+                        help='Largest channel gap within a missed cluster')
+    parser.add_argument('--top', dest='top', type=int, default=10,
+                        help='Number of channels and missed clusters listed')
+    parser.add_argument('-p', '--plot', action="store_true",
+                        help="Save the capture fraction plots and the dataset vs triggered TPs event display")
+    parser.add_argument('--display', choices=DISPLAYS, default="auto",
+                        help="Event display type of the dataset TPs")
+
+    args = parser.parse_args()
+    main(args.dataset, args.triggered, args.output, args.time_bin, args.adc_threshold, args.cluster_time,
+         args.cluster_channels, args.top, args.display, args.plot)
@@ -0,0 +1,131 @@
+# Per-stage instrumentation of the analysis pipelines: wall and CPU time, peak RSS,
+# records in and out and throughput of every stage, written out as a JSON report.
+# The hottest stage can also be dumped as cProfile statistics. A disabled profiler
+# measures nothing, so the stages can be wrapped unconditionally.
+import cProfile
+import json
+import resource
+import sys
+import time
+from contextlib import contextmanager
+
+
+class Stage:
+    """
+    Measurements of one pipeline stage. The records in and out are set by the
+    caller inside the stage, whenever they are known.
+    """
+    def __init__(self, name, records_in=None):
+        self.name = name
+        self.records_in = records_in
+        self.records_out = None
+        self.wall_s = 0.
+        self.cpu_s = 0.
+        self.peak_rss_mb = None
+        self.profile = None
+
+    def to_dict(self):
+        records = self.records_in if self.records_in is not None else self.records_out
+        return {"stage": self.name, "wall_s": self.wall_s, "cpu_s": self.cpu_s, "peak_rss_mb": self.peak_rss_mb,
+                "records_in": self.records_in, "records_out": self.records_out,
+                "records_per_s": records/self.wall_s if records is not None and self.wall_s > 0 else None}
+
+
+def reset_peak_rss():
+    """
+    Reset the peak RSS of the process, so it can be read per stage. Only Linux
+    supports this; elsewhere the peak RSS is the process-wide high-water mark.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        pass
+
+
+def get_peak_rss_mb():
+    """
+    Peak RSS of the process in MB since the last reset_peak_rss.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1])/1024
+    except OSError:
+        pass
+    # ru_maxrss is in kB on Linux and in bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak/1024**2 if sys.platform == "darwin" else peak/1024
+
+
+class StageProfiler:
+    """
+    Collects the measurements of the stages of one pipeline run.
+    """
+    def __init__(self, enabled=True, cprofile=False):
+        """
+        :param enabled: Measure the stages, otherwise stage() does nothing.
+        :param cprofile: Also run every stage under cProfile, to dump the
+            hottest one. This slows down python level code.
+        """
+        self.enabled = enabled
+        self.cprofile = cprofile
+        self.stages = []
+        self.start = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name, records_in=None):
+        """
+        Measure the enclosed code as one stage.
+        :param name: Stage name.
+        :param records_in: Number of records going into the stage, if known up front.
+        :return: context manager yielding the Stage, to set its records in and out
+        """
+        stage = Stage(name, records_in)
+        if not self.enabled:
+            yield stage
+            return
+        reset_peak_rss()
+        if self.cprofile:
+            stage.profile = cProfile.Profile()
+            stage.profile.enable()
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield stage
+        finally:
+            stage.wall_s = time.perf_counter() - wall
+            stage.cpu_s = time.process_time() - cpu
+            if stage.profile is not None:
+                stage.profile.disable()
+            stage.peak_rss_mb = get_peak_rss_mb()
+            self.stages.append(stage)
+
+    def report(self, **info):
+        """
+        :param info: Extra fields describing the run, e.g. the input file.
+        :return: JSON serialisable report of all the stages
+        """
+        return dict(info, total_wall_s=time.perf_counter() - self.start, cprofile=self.cprofile,
+                    stages=[stage.to_dict() for stage in self.stages])
+
+    def save(self, report_file, cprofile_file=None, **info):
+        """
+        Write the JSON report, and the cProfile statistics of the stage with the
+        longest wall time.
+        :param report_file: JSON report output file.
+        :param cprofile_file: Optional cProfile statistics output file, for pstats or snakeviz.
+        :param info: Extra fields describing the run, e.g. the input file.
+        """
+        with open(report_file, "w") as f:
+            json.dump(self.report(**info), f, indent=1)
+        print("Saved the stage profile to ", report_file)
+        profiled = [stage for stage in self.stages if stage.profile is not None]
+        if cprofile_file and profiled:
+            hottest = max(profiled, key=lambda stage: stage.wall_s)
+            hottest.profile.dump_stats(cprofile_file)
+            print("Saved the cProfile statistics of the ", hottest.name, " stage to ", cprofile_file)
+
+
+# Shared disabled profiler, the default of the instrumented functions
+NO_PROFILER = StageProfiler(enabled=False)
@@ -0,0 +1,207 @@
+# Synthetic inputs for testing and benchmarking the scripts without real runs: DAQ
+# logs with the 'TPs Received.', 'TPs Requested:' and 'MLT TD Sent:' records read by
+# daq_trigger_latencies.py, and blocky TPStream TP dumps read by generate_tp_dataset.py.
+# Everything is generated and formatted in vectorized chunks, so 10^7 record inputs
+# take seconds and bounded memory.
+import argparse
+import numpy as np
+from tp_io import TPTextWriter, TP_COLUMNS, WRITE_BUFFER_SIZE
+
+LOG_ORDERS = ("time", "shuffled")
+TP_ORDERS = ("sorted", "blocky", "shuffled")
+
+# Number of TPs generated at a time
+GENERATE_CHUNK_ROWS = 1 << 18
+
+# First TP tick and the matching wall clock time in ns
+RUN_START_TICK = 10**17
+RUN_START_NS = 1665000000*10**9
+TICK_NS = 16
+
+LOG_LINE_FORMATS = {
+    "tp_received": "2022-Oct-06 12:00:00,000 INFO [dunedaq::trigger::TPSetReceiver] TPs Received. time_start: %d"
+                   " ADC integral: %d real_time_in: %d real_time_buff: %d\n",
+    "td_sent": "2022-Oct-06 12:00:00,000 INFO [dunedaq::trigger::ModuleLevelTrigger] MLT TD Sent: readout_start: %d"
+               " readout_end: %d time_td_sent: %d\n",
+    "tp_requests": "2022-Oct-06 12:00:00,000 INFO [dunedaq::trigger::TPBuffer] TPs Requested: window_begin: %d"
+                   " window_end: %d real_time_req: %d real_time_han: %d\n",
+    "noise": "2022-Oct-06 12:00:00,000 DEBUG [dunedaq::dfmodules::DataWriter] Unrelated message number %d\n",
+}
+
+
+def format_lines(line_format, rows):
+    """
+    Format integer rows into log lines with one C-level formatting call.
+    :return: list of the lines
+    """
+    if len(rows) == 0:
+        return []
+    return ((line_format*len(rows)) % tuple(rows.ravel().tolist())).splitlines(keepends=True)
+
+
+def tick_to_ns(ticks):
+    return RUN_START_NS + (ticks - RUN_START_TICK)*TICK_NS
+
+
+def generate_tp_times(rng, num_tps, first_tick, mean_gap):
+    """
+    Time ordered TP start ticks with exponentially distributed gaps.
+    """
+    return first_tick + np.cumsum(rng.exponential(mean_gap, num_tps).astype(np.int64) + 1)
+
+
+def generate_log_chunk(rng, times, requests_per_tp, window_ticks, dr_fraction, noise_fraction):
+    """
+    Generate the records of one chunk of TPs.
+    :return: dictionary of record name to (rows, tokens) int64 array, and to the
+        wall clock time in ns each record is logged at
+    """
+    num_tps = len(times)
+    time_in = tick_to_ns(times) + rng.integers(10**6, 10**7, num_tps)
+    time_buff = time_in + rng.integers(0, 10**5, num_tps)
+    records = {"tp_received": np.column_stack((times, rng.integers(0, 5000, num_tps), time_in, time_buff))}
+    log_times = {"tp_received": time_buff}
+
+    num_tds = rng.binomial(num_tps, requests_per_tp)
+    begins = np.sort(rng.choice(times, num_tds))
+    ends = begins + rng.integers(0, window_ticks, num_tds)
+    td_sent = tick_to_ns(ends) + rng.integers(2*10**7, 4*10**7, num_tds)
+    records["td_sent"] = np.column_stack((begins, ends, td_sent))
+    log_times["td_sent"] = td_sent
+
+    # Most TDs get one DataRequest, a few none or two
+    num_requests = rng.choice([0, 1, 2], num_tds, p=[1 - dr_fraction, 0.9*dr_fraction, 0.1*dr_fraction])
+    request_td = np.repeat(np.arange(num_tds), num_requests)
+    received = td_sent[request_td] + rng.integers(10**5, 10**6, len(request_td))
+    handled = received + rng.integers(0, 10**6, len(request_td))
+    records["tp_requests"] = np.column_stack((begins[request_td], ends[request_td], received, handled))
+    log_times["tp_requests"] = handled
+
+    num_noise = rng.binomial(num_tps, noise_fraction)
+    records["noise"] = rng.integers(0, 10**6, (num_noise, 1))
+    log_times["noise"] = rng.choice(time_buff, num_noise)
+    return records, log_times
+
+
+def write_daq_log(file, num_tps, requests_per_tp=0.005, window_ticks=2000, dr_fraction=0.97, noise_fraction=0.05,
+                  order="time", mean_gap=10, seed=0, chunk_rows=GENERATE_CHUNK_ROWS):
+    """
+    Write a synthetic DAQ log. Each chunk of TPs gets TriggerDecisions with
+    readout windows over its TPs, and DataRequests for most of them, with
+    realistic latencies between the stages.
+    :param file: Output log file.
+    :param num_tps: Number of 'TPs Received.' records.
+    :param requests_per_tp: Number of TriggerDecisions per TP.
+    :param window_ticks: Largest readout window length in ticks.
+    :param dr_fraction: Fraction of the TriggerDecisions with DataRequests.
+    :param noise_fraction: Number of unrelated log lines per TP.
+    :param order: "time" to write the lines in logging time order, or "shuffled"
+        to shuffle them within each chunk.
+    :param mean_gap: Mean gap between TP start times in ticks.
+    :param seed: Random seed.
+    :param chunk_rows: Number of TPs generated at a time.
+    :return: dictionary of record name to the number of records written
+    """
+    rng = np.random.default_rng(seed)
+    counts = dict.fromkeys(LOG_LINE_FORMATS, 0)
+    last_tick = RUN_START_TICK
+    with open(file, 'w', buffering=WRITE_BUFFER_SIZE) as f:
+        for begin in range(0, num_tps, chunk_rows):
+            times = generate_tp_times(rng, min(chunk_rows, num_tps - begin), last_tick, mean_gap)
+            last_tick = times[-1]
+            records, log_times = generate_log_chunk(rng, times, requests_per_tp, window_ticks, dr_fraction,
+                                                    noise_fraction)
+            lines = []
+            for name, rows in records.items():
+                lines += format_lines(LOG_LINE_FORMATS[name], rows)
+                counts[name] += len(rows)
+            if order == "time":
+                line_order = np.argsort(np.concatenate(list(log_times.values())), kind='stable')
+            else:
+                line_order = rng.permutation(len(lines))
+            f.writelines([lines[i] for i in line_order])
+    del counts["noise"]
+    return counts
+
+
+def generate_tp_chunk(rng, times, num_channels):
+    """
+    Generate TPs in the TPStream column order for time ordered start ticks.
+    """
+    num_tps = len(times)
+    time_over_threshold = rng.integers(1, 100, num_tps)
+    columns = {"start_time": times,
+               "time_over_threshold": time_over_threshold,
+               "time_peak": times + rng.integers(0, time_over_threshold + 1),
+               "channel": rng.integers(0, num_channels, num_tps),
+               "adc_integral": rng.integers(1, 5000, num_tps),
+               "adc_peak": rng.integers(1, 500, num_tps),
+               "type": np.ones(num_tps, dtype=np.int64),
+               "det_id": np.full(num_tps, 3, dtype=np.int64)}
+    return np.column_stack([columns[column] for column in TP_COLUMNS])
+
+
+def write_blocky_tps(file, num_tps, order="blocky", num_channels=3072, num_links=12, fragment_ticks=4096,
+                     mean_gap=10, seed=0, chunk_rows=GENERATE_CHUNK_ROWS):
+    """
+    Write a synthetic TP text dump in the TPStream column order. The "blocky"
+    order mimics the TPStream files: the TPs are written fragment by fragment,
+    each fragment holding fragment_ticks of one link, with all the links of a
+    time slice in turn, so the file is only time ordered within each block.
+    :param file: Output TP text file.
+    :param num_tps: Number of TPs.
+    :param order: "sorted", "blocky", or "shuffled" within each chunk.
+    :param num_channels: Number of channels, split evenly between the links.
+    :param num_links: Number of links.
+    :param fragment_ticks: Time slice length of the blocky fragments, in ticks.
+    :param mean_gap: Mean gap between TP start times in ticks.
+    :param seed: Random seed.
+    :param chunk_rows: Number of TPs generated at a time.
+    :return: number of TPs written
+    """
+    rng = np.random.default_rng(seed)
+    last_tick = RUN_START_TICK
+    with TPTextWriter(file) as writer:
+        for begin in range(0, num_tps, chunk_rows):
+            times = generate_tp_times(rng, min(chunk_rows, num_tps - begin), last_tick, mean_gap)
+            last_tick = times[-1]
+            chunk = generate_tp_chunk(rng, times, num_channels)
+            if order == "blocky":
+                link = chunk[:, TP_COLUMNS.index("channel")]*num_links//num_channels
+                fragment = (times - RUN_START_TICK)//fragment_ticks
+                chunk = chunk[np.argsort(fragment*num_links + link, kind='stable')]
+            elif order == "shuffled":
+                chunk = chunk[rng.permutation(len(chunk))]
+            writer.write(chunk)
+    return writer.num_rows
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Generate synthetic DAQ logs and TPStream TP dumps")
+    parser.add_argument('kind', choices=["log", "tps"], help='Generate a DAQ log or a TP text dump')
+    parser.add_argument('out', help='Output file')
+    parser.add_argument('-n', '--num-tps', dest='num_tps', type=float, default=1e5, help='Number of TPs')
+    parser.add_argument('--order', dest='order', default=None,
+                        help='Line order: ' + "/".join(LOG_ORDERS) + ' for logs, ' + "/".join(TP_ORDERS)
+                             + ' for TP dumps. Defaults to time and blocky')
+    parser.add_argument('--requests-per-tp', dest='requests_per_tp', type=float, default=0.005,
+                        help='Number of TriggerDecisions per TP in the log')
+    parser.add_argument('--noise', dest='noise', type=float, default=0.05,
+                        help='Number of unrelated log lines per TP')
+    parser.add_argument('--links', dest='links', type=int, default=12, help='Number of links in the TP dump')
+    parser.add_argument('--seed', dest='seed', type=int, default=0, help='Random seed')
+
+    args = parser.parse_args()
+    if args.kind == "log":
+        order = args.order if args.order else "time"
+        if order not in LOG_ORDERS:
+            parser.error("log order must be one of " + ", ".join(LOG_ORDERS))
+        counts = write_daq_log(args.out, int(args.num_tps), args.requests_per_tp, noise_fraction=args.noise,
+                               order=order, seed=args.seed)
+        print("Wrote ", counts, " records to ", args.out)
+    else:
+        order = args.order if args.order else "blocky"
+        if order not in TP_ORDERS:
+            parser.error("TP dump order must be one of " + ", ".join(TP_ORDERS))
+        written = write_blocky_tps(args.out, int(args.num_tps), order, num_links=args.links, seed=args.seed)
+        print("Wrote ", written, " TPs to ", args.out)
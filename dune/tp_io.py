@@ -0,0 +1,524 @@
+# Readers and writers for the trigger primitive (TP) text files: the TPs extracted
+# from TPStream files and the offline TP datasets made from them. All the columns
+# are integers, and the 16 ns tick timestamps (~1e17) do not fit exactly in a
+# float64, so everything is kept as int64.
+import argparse
+import heapq
+import itertools
+import os
+import struct
+import tempfile
+import warnings
+import numpy as np
+
+# Columns of the TPs extracted from the TPStream files
+TP_COLUMNS = ("start_time", "time_over_threshold", "time_peak", "channel",
+              "adc_integral", "adc_peak", "type", "det_id")
+
+# Column order of the offline TP datasets, as expected by the replay app and
+# the triggerprimitivemaker in DUNE DAQ
+DATASET_COLUMNS = ("start_time", "time_over_threshold", "time_peak", "channel",
+                   "adc_integral", "adc_peak", "det_id", "type")
+
+# Indices of the dataset columns in the TPStream column order
+DATASET_ORDER = [TP_COLUMNS.index(column) for column in DATASET_COLUMNS]
+
+# Binary TP dataset format: a fixed size little-endian header, followed by the
+# TPs as rows of little-endian int64 columns. The header holds the magic, format
+# version, number of columns, tick period in ns, run number, number of TPs and
+# the column names, and is padded so the records start at BINARY_HEADER_SIZE.
+BINARY_MAGIC = b"TPDS"
+BINARY_VERSION = 1
+BINARY_HEADER_FORMAT = "<4sHHd16sQ"
+BINARY_COLUMN_NAME_SIZE = 24
+BINARY_HEADER_SIZE = 512
+TICK_PERIOD_NS = 16.
+
+# Sidecar time-block index: for every block of INDEX_BLOCK_ROWS TPs, the byte
+# offset (text) or record offset (binary) of its first TP, its number of TPs
+# and its smallest and largest start time. The min/max times make the index
+# valid for blocky, not time ordered, TPStream dumps too.
+INDEX_SUFFIX = ".idx.npy"
+INDEX_BLOCK_ROWS = 1 << 16
+INDEX_DTYPE = np.dtype([("offset", "<i8"), ("rows", "<i8"), ("time_min", "<i8"), ("time_max", "<i8")])
+
+# Number of lines parsed at a time
+CHUNK_ROWS = 1 << 20
+
+# Number of TPs buffered per sorted run while merging
+MERGE_BLOCK_ROWS = 1 << 13
+
+# Number of lines formatted at a time, and the size of the output write buffer
+WRITE_BLOCK_ROWS = 1 << 16
+WRITE_BUFFER_SIZE = 1 << 22
+
+
+def iter_tp_chunks(file, chunk_rows=CHUNK_ROWS):
+    """
+    Read a space separated TP text file in chunks of lines, parsing each chunk
+    straight into int64 with numpy's C text reader.
+    :param file: TP text file, one TP per line.
+    :param chunk_rows: Number of lines per chunk.
+    :return: generator of (rows, columns) int64 arrays, in file order
+    """
+    with open(file) as f:
+        while True:
+            # loadtxt reads the next chunk_rows lines straight from the file,
+            # and warns when none are left
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", UserWarning)
+                chunk = np.loadtxt(f, dtype=np.int64, max_rows=chunk_rows, ndmin=2)
+            if len(chunk) == 0:
+                break
+            yield chunk
+
+
+def read_tp_file(file, chunk_rows=CHUNK_ROWS):
+    """
+    Read a whole TP text file into a single int64 array.
+    :param file: TP text file, one TP per line.
+    :param chunk_rows: Number of lines parsed at a time.
+    :return: (rows, columns) int64 array
+    """
+    chunks = list(iter_tp_chunks(file, chunk_rows))
+    if not chunks:
+        return np.empty((0, len(TP_COLUMNS)), dtype=np.int64)
+    return np.concatenate(chunks)
+
+
+def format_tp_rows(rows):
+    """
+    Format integer TP rows as space separated text lines, with a single
+    C-level string formatting call for the whole block.
+    :param rows: (rows, columns) integer array.
+    :return: text of the lines, each ending with a newline
+    """
+    if len(rows) == 0:
+        return ""
+    line_format = " ".join(["%d"]*rows.shape[1]) + "\n"
+    return (line_format*len(rows)) % tuple(rows.ravel().tolist())
+
+
+class TPTextWriter:
+    """
+    Writer of space separated TP text files through a large write buffer,
+    formatting block_rows lines at a time. Blocks formatted elsewhere, e.g. by
+    a worker pool, can be written with write_text.
+    """
+    def __init__(self, file, block_rows=WRITE_BLOCK_ROWS):
+        self.file = open(file, 'w', buffering=WRITE_BUFFER_SIZE)
+        self.block_rows = block_rows
+        self.num_rows = 0
+
+    def write(self, rows):
+        for begin in range(0, len(rows), self.block_rows):
+            self.file.write(format_tp_rows(rows[begin:begin + self.block_rows]))
+        self.num_rows += len(rows)
+
+    def write_text(self, text, num_rows):
+        self.file.write(text)
+        self.num_rows += num_rows
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_tp_text(file, chunks, block_rows=WRITE_BLOCK_ROWS):
+    """
+    Write TP rows to a space separated text file through a large write buffer,
+    formatting block_rows lines at a time.
+    :param file: Output text file name.
+    :param chunks: (rows, columns) integer array, or an iterable of them.
+    :param block_rows: Number of lines formatted at a time.
+    :return: number of TPs written
+    """
+    if isinstance(chunks, np.ndarray):
+        chunks = [chunks]
+    with TPTextWriter(file, block_rows) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer.num_rows
+
+
+def spill_sorted_runs(file, spill_dir, chunk_rows=CHUNK_ROWS):
+    """
+    First pass of the external merge sort. The input is read one chunk at a
+    time; a chunk spanning several time ordered blocks is sorted in memory, and
+    chunks that continue the current time ordered run are appended to its
+    spill file. A fully time ordered input gives a single run.
+    :param file: TP text file, one TP per line.
+    :param spill_dir: Directory for the spill files.
+    :param chunk_rows: Number of lines read at a time.
+    :return: list of (spill file, number of TPs) of the sorted runs
+    """
+    runs = []
+    spill = None
+    last_time = None
+    for chunk in iter_tp_chunks(file, chunk_rows):
+        if not check_sorted(chunk[:, 0]):
+            chunk = chunk[chunk[:, 0].argsort(kind='stable')]
+        if last_time is None or chunk[0, 0] < last_time:
+            if spill is not None:
+                spill.close()
+            runs.append([os.path.join(spill_dir, "run_" + str(len(runs)) + ".bin"), 0])
+            spill = open(runs[-1][0], 'wb')
+        chunk.astype('<i8').tofile(spill)
+        runs[-1][1] += len(chunk)
+        last_time = chunk[-1, 0]
+    if spill is not None:
+        spill.close()
+    return [tuple(run) for run in runs]
+
+
+def check_sorted(times):
+    """
+    Check whether an array of times is in non-decreasing order.
+    """
+    return bool(np.all(times[1:] >= times[:-1]))
+
+
+class SortedRunReader:
+    """
+    Buffered reader of one spilled run, holding block_rows TPs at a time.
+    """
+    def __init__(self, file, num_rows, num_columns, block_rows):
+        self.file = file
+        self.num_rows = num_rows
+        self.num_columns = num_columns
+        self.block_rows = block_rows
+        self.position = 0
+        self.buffer = np.empty((0, num_columns), dtype=np.int64)
+        self.refill()
+
+    def refill(self):
+        count = min(self.block_rows, self.num_rows - self.position)
+        self.buffer = np.fromfile(self.file, dtype='<i8', count=count*self.num_columns,
+                                  offset=self.position*self.num_columns*8).reshape(count, self.num_columns)
+        self.position += count
+
+    def take_until(self, time):
+        """
+        Remove and return the buffered TPs starting at or before time,
+        refilling the buffer once it is used up.
+        """
+        end = np.searchsorted(self.buffer[:, 0], time, side='right')
+        taken = self.buffer[:end]
+        self.buffer = self.buffer[end:]
+        if len(self.buffer) == 0:
+            self.refill()
+        return taken
+
+
+def merge_sorted_runs(runs, num_columns, block_rows=MERGE_BLOCK_ROWS):
+    """
+    Second pass of the external merge sort: a block-wise k-way merge of the
+    sorted runs. Each run keeps one block buffered, and at every step all the
+    TPs up to the frontier, the smallest last buffered time, are emitted, since
+    no run can still hold an earlier TP. One heap keyed on the last buffered
+    times gives the frontier, and another keyed on the first buffered times
+    gives the runs holding TPs up to it, so only those runs are touched.
+    Memory is bounded by the number of runs times block_rows.
+    :param runs: list of (spill file, number of TPs) from spill_sorted_runs.
+    :param num_columns: Number of TP columns.
+    :param block_rows: Number of TPs buffered per run.
+    :return: generator of time ordered (rows, columns) int64 arrays
+    """
+    readers = [SortedRunReader(file, num_rows, num_columns, block_rows) for file, num_rows in runs]
+    last_heap = [(int(reader.buffer[-1, 0]), i) for i, reader in enumerate(readers) if len(reader.buffer)]
+    first_heap = [(int(reader.buffer[0, 0]), i) for i, reader in enumerate(readers) if len(reader.buffer)]
+    heapq.heapify(last_heap)
+    heapq.heapify(first_heap)
+    while last_heap:
+        frontier = last_heap[0][0]
+        touched = []
+        while first_heap and first_heap[0][0] <= frontier:
+            touched.append(heapq.heappop(first_heap)[1])
+        # In run order, so TPs with equal times keep their input order
+        touched.sort()
+        parts = [readers[i].take_until(frontier) for i in touched]
+        for i in touched:
+            if len(readers[i].buffer):
+                heapq.heappush(first_heap, (int(readers[i].buffer[0, 0]), i))
+        # Only the runs ending at the frontier were used up and refilled, the
+        # others keep their last time
+        refilled = []
+        while last_heap and last_heap[0][0] <= frontier:
+            refilled.append(heapq.heappop(last_heap)[1])
+        for i in refilled:
+            if len(readers[i].buffer):
+                heapq.heappush(last_heap, (int(readers[i].buffer[-1, 0]), i))
+        if len(parts) == 1:
+            yield parts[0]
+            continue
+        merged = np.concatenate(parts)
+        yield merged[merged[:, 0].argsort(kind='stable')]
+
+
+def iter_time_ordered_tps(file, chunk_rows=CHUNK_ROWS, block_rows=MERGE_BLOCK_ROWS, spill_dir=None):
+    """
+    Stream the TPs of a blocky TPStream text file in time order with an
+    external merge sort, without loading the whole file. Memory is bounded by
+    chunk_rows while reading, and by the number of sorted runs times
+    block_rows while merging. The whole input is spilled before the merge
+    starts, taking about as much temporary disk space as the input.
+    :param file: TP text file, one TP per line.
+    :param chunk_rows: Number of lines read at a time.
+    :param block_rows: Number of TPs buffered per run while merging.
+    :param spill_dir: Directory for the temporary spill files, the system default if None.
+    :return: generator of time ordered (rows, columns) int64 arrays
+    """
+    with tempfile.TemporaryDirectory(dir=spill_dir) as tmp_dir:
+        print("Splitting the input into time ordered runs...")
+        runs = spill_sorted_runs(file, tmp_dir, chunk_rows)
+        print("Merging ", len(runs), " time ordered runs...")
+        yield from merge_sorted_runs(runs, len(TP_COLUMNS), block_rows)
+
+
+class TPBinaryWriter:
+    """
+    Writer of the binary TP dataset format. Rows can be written in any number
+    of blocks; the number of TPs in the header is filled in on close.
+    """
+    def __init__(self, file, columns=DATASET_COLUMNS, run="", tick_period_ns=TICK_PERIOD_NS):
+        self.file = open(file, 'wb')
+        self.columns = tuple(columns)
+        self.run = str(run)
+        self.tick_period_ns = tick_period_ns
+        self.num_rows = 0
+        self.write_header()
+
+    def write_header(self):
+        header = struct.pack(BINARY_HEADER_FORMAT, BINARY_MAGIC, BINARY_VERSION, len(self.columns),
+                             self.tick_period_ns, self.run.encode(), self.num_rows)
+        header += b"".join(struct.pack(str(BINARY_COLUMN_NAME_SIZE) + "s", column.encode())
+                           for column in self.columns)
+        if len(header) > BINARY_HEADER_SIZE:
+            raise ValueError("Too many columns for the binary TP dataset header")
+        self.file.seek(0)
+        self.file.write(header.ljust(BINARY_HEADER_SIZE, b"\0"))
+
+    def write(self, rows):
+        if rows.shape[1] != len(self.columns):
+            raise ValueError("Expected " + str(len(self.columns)) + " columns, got " + str(rows.shape[1]))
+        self.file.write(np.ascontiguousarray(rows, dtype='<i8').tobytes())
+        self.num_rows += len(rows)
+
+    def close(self):
+        self.write_header()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def write_tp_binary(file, chunks, columns=DATASET_COLUMNS, run="", tick_period_ns=TICK_PERIOD_NS):
+    """
+    Write TP rows to the binary TP dataset format.
+    :param file: Output binary file name.
+    :param chunks: (rows, columns) integer array, or an iterable of them.
+    :param columns: Names of the columns.
+    :param run: Run number stored in the header.
+    :param tick_period_ns: Period of the timestamp ticks in ns.
+    :return: number of TPs written
+    """
+    if isinstance(chunks, np.ndarray):
+        chunks = [chunks]
+    with TPBinaryWriter(file, columns, run, tick_period_ns) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer.num_rows
+
+
+def is_tp_binary(file):
+    """
+    Check whether a file is in the binary TP dataset format.
+    """
+    with open(file, 'rb') as f:
+        return f.read(len(BINARY_MAGIC)) == BINARY_MAGIC
+
+
+def read_tp_binary_header(file):
+    """
+    Read the header of a binary TP dataset file.
+    :param file: Binary TP dataset file.
+    :return: dictionary with the version, columns, tick_period_ns, run and num_rows
+    """
+    with open(file, 'rb') as f:
+        header = f.read(BINARY_HEADER_SIZE)
+    magic, version, num_columns, tick_period_ns, run, num_rows = struct.unpack_from(BINARY_HEADER_FORMAT, header)
+    if magic != BINARY_MAGIC:
+        raise ValueError(file + " is not a binary TP dataset")
+    if version != BINARY_VERSION:
+        raise ValueError(file + " has binary TP dataset version " + str(version) + ", expected " + str(BINARY_VERSION))
+    names_offset = struct.calcsize(BINARY_HEADER_FORMAT)
+    columns = tuple(header[names_offset + i*BINARY_COLUMN_NAME_SIZE:names_offset + (i + 1)*BINARY_COLUMN_NAME_SIZE]
+                    .rstrip(b"\0").decode() for i in range(num_columns))
+    return {"version": version, "columns": columns, "tick_period_ns": tick_period_ns,
+            "run": run.rstrip(b"\0").decode(), "num_rows": num_rows}
+
+
+def read_tp_binary(file):
+    """
+    Open a binary TP dataset as a zero-copy, read-only memory map.
+    :param file: Binary TP dataset file.
+    :return: header dictionary, (rows, columns) int64 memory map
+    """
+    header = read_tp_binary_header(file)
+    if header["num_rows"] == 0:
+        return header, np.empty((0, len(header["columns"])), dtype='<i8')
+    data = np.memmap(file, dtype='<i8', mode='r', offset=BINARY_HEADER_SIZE,
+                     shape=(header["num_rows"], len(header["columns"])))
+    return header, data
+
+
+def read_tp_dataset(file):
+    """
+    Read a TP dataset in either the binary or the text format.
+    :param file: TP dataset file.
+    :return: (rows, columns) int64 array, memory mapped for binary files
+    """
+    if is_tp_binary(file):
+        return read_tp_binary(file)[1]
+    return read_tp_file(file)
+
+
+def text_to_binary(text_file, binary_file, columns=DATASET_COLUMNS, run="", chunk_rows=CHUNK_ROWS):
+    """
+    Convert a TP text file to the binary TP dataset format, chunk by chunk.
+    :return: number of TPs converted
+    """
+    return write_tp_binary(binary_file, iter_tp_chunks(text_file, chunk_rows), columns, run)
+
+
+def binary_to_text(binary_file, text_file, block_rows=WRITE_BLOCK_ROWS):
+    """
+    Convert a binary TP dataset back to text, e.g. to produce the replay app
+    input on demand. The output is identical to the text the dataset was made from.
+    :return: number of TPs converted
+    """
+    return write_tp_text(text_file, read_tp_binary(binary_file)[1], block_rows)
+
+
+def iter_index_blocks(file, block_rows=INDEX_BLOCK_ROWS):
+    """
+    Scan a TP text or binary file block by block for the time-block index.
+    :return: generator of (offset, start times) of each block
+    """
+    if is_tp_binary(file):
+        data = read_tp_binary(file)[1]
+        for begin in range(0, len(data), block_rows):
+            yield begin, np.asarray(data[begin:begin + block_rows, 0])
+        return
+    offset = 0
+    with open(file, 'rb') as f:
+        while True:
+            lines = list(itertools.islice(f, block_rows))
+            if not lines:
+                break
+            yield offset, np.loadtxt(lines, dtype=np.int64, usecols=0, ndmin=1)
+            offset += sum(map(len, lines))
+
+
+def build_tp_index(file, block_rows=INDEX_BLOCK_ROWS):
+    """
+    Build the time-block index of a TP text or binary file with one pass over it.
+    :param file: TP file.
+    :param block_rows: Number of TPs per index block.
+    :return: INDEX_DTYPE structured array, one entry per block
+    """
+    entries = [(offset, len(times), times.min(), times.max()) for offset, times in iter_index_blocks(file, block_rows)]
+    return np.array(entries, dtype=INDEX_DTYPE)
+
+
+def get_tp_index(file, block_rows=INDEX_BLOCK_ROWS):
+    """
+    Load the sidecar time-block index of a TP file, building and saving it
+    first if it is missing or older than the file.
+    :param file: TP file, the index is stored next to it as file + INDEX_SUFFIX.
+    :param block_rows: Number of TPs per index block, when building the index.
+    :return: INDEX_DTYPE structured array, one entry per block
+    """
+    index_file = file + INDEX_SUFFIX
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(file):
+        return np.load(index_file)
+    print("Building the time-block index of ", file, "...")
+    index = build_tp_index(file, block_rows)
+    try:
+        np.save(index_file, index)
+    except OSError:
+        print("Could not save the index to ", index_file, ", it will be rebuilt next time.")
+    return index
+
+
+def get_tp_columns(file):
+    """
+    Column names of a TP file: from the header of binary files, the TPStream
+    order for text files.
+    """
+    if is_tp_binary(file):
+        return read_tp_binary_header(file)["columns"]
+    return TP_COLUMNS
+
+
+def read_tp_window(file, time_begin, time_end, index=None):
+    """
+    Read the TPs starting in [time_begin, time_end) using the time-block index,
+    seeking straight to the blocks that can hold them, so the I/O scales with
+    the window rather than with the file.
+    :param file: TP text or binary file.
+    :param time_begin: First start time of the window, in ticks.
+    :param time_end: End of the window, in ticks.
+    :param index: Time-block index of the file, loaded with get_tp_index if None.
+    :return: time ordered (rows, columns) int64 array, in the file column order
+    """
+    if index is None:
+        index = get_tp_index(file)
+    blocks = index[(index["time_max"] >= time_begin) & (index["time_min"] < time_end)]
+    if is_tp_binary(file):
+        data = read_tp_binary(file)[1]
+        chunks = [np.asarray(data[block["offset"]:block["offset"] + block["rows"]]) for block in blocks]
+    else:
+        chunks = []
+        with open(file, 'rb') as f:
+            for block in blocks:
+                f.seek(block["offset"])
+                chunks.append(np.loadtxt(list(itertools.islice(f, block["rows"])), dtype=np.int64, ndmin=2))
+    if not chunks:
+        return np.empty((0, len(get_tp_columns(file))), dtype=np.int64)
+    window = np.concatenate(chunks)
+    window = window[(window[:, 0] >= time_begin) & (window[:, 0] < time_end)]
+    return window[window[:, 0].argsort(kind='stable')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert TP datasets between the text and the binary format, or index them")
+    parser.add_argument('direction', choices=["to-binary", "to-text", "index"],
+                        help='Conversion direction, or index to build the sidecar time-block index of the input')
+    parser.add_argument('input', help='Input TP dataset')
+    parser.add_argument('output', nargs='?', help='Output TP dataset')
+    parser.add_argument('-r', '--run', dest='run', default="", help='Run number stored in the binary header')
+    parser.add_argument('--tpstream', action="store_true",
+                        help="The text input has the TPStream column order rather than the dataset one")
+
+    args = parser.parse_args()
+    if args.direction == "index":
+        index = get_tp_index(args.input)
+        print("Indexed ", index["rows"].sum(), " TPs in ", len(index), " blocks.")
+    elif args.output is None:
+        parser.error("the output file is required for the conversions")
+    else:
+        if args.direction == "to-binary":
+            converted = text_to_binary(args.input, args.output, TP_COLUMNS if args.tpstream else DATASET_COLUMNS,
+                                       args.run)
+        else:
+            converted = binary_to_text(args.input, args.output)
+        print("Converted ", converted, " TPs.")
@@ -0,0 +1,240 @@
+# Offline emulator of the trigger activity algorithms, run directly over time ordered
+# TP datasets from generate_tp_dataset.py instead of through the DAQ replay app. The
+# candidate windows are written out in the triggered TP format, i.e. the dataset TPs
+# falling in the windows, and thresholds can be swept over many points in parallel.
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import argparse
+from tp_io import read_tp_dataset, write_tp_text, write_tp_binary, check_sorted, DATASET_COLUMNS
+
+ALGORITHMS = ("adc_sum", "adjacency")
+
+TIME_COLUMN = DATASET_COLUMNS.index("start_time")
+CHANNEL_COLUMN = DATASET_COLUMNS.index("channel")
+ADC_COLUMN = DATASET_COLUMNS.index("adc_integral")
+
+# Dataset loaded once per sweep worker process
+WORKER_DATA = None
+
+
+def read_dataset(file):
+    """
+    Read a TP dataset, text or binary, time ordering it if needed.
+    :return: time ordered (rows, dataset columns) int64 array
+    """
+    data = read_tp_dataset(file)
+    if not check_sorted(data[:, TIME_COLUMN]):
+        print("Dataset is not time ordered, ordering now...")
+        data = data[data[:, TIME_COLUMN].argsort(kind='stable')]
+    return data
+
+
+def adc_sum_windows(data, window, threshold):
+    """
+    ADC sum threshold algorithm: a candidate opens at the first TP whose next
+    window ticks (starting at its own start time) hold an ADC sum of at least
+    threshold, and lasts window ticks. The next candidate can only open after
+    it ends. The sums for all the TPs come from one cumulative sum and a binary
+    search; only the candidates themselves are looped over.
+    :param data: Time ordered (rows, dataset columns) int64 array.
+    :param window: Length of the summing window in ticks.
+    :param threshold: Smallest ADC sum in a window that triggers.
+    :return: (candidates, 2) int64 array of [begin, end) windows in ticks
+    """
+    times = data[:, TIME_COLUMN]
+    cumulative = np.concatenate(([0], np.cumsum(data[:, ADC_COLUMN])))
+    ends = np.searchsorted(times, times + window, side='left')
+    triggering = times[cumulative[ends] - cumulative[:-1] >= threshold]
+
+    begins = []
+    position = 0
+    while position < len(triggering):
+        begins.append(triggering[position])
+        position = np.searchsorted(triggering, triggering[position] + window, side='left')
+    begins = np.array(begins, dtype=np.int64)
+    return np.column_stack((begins, begins + window))
+
+
+def adjacency_windows(data, window, threshold, tolerance=1):
+    """
+    Channel adjacency algorithm: the TPs are split into consecutive windows of
+    window ticks, and a window triggers when it holds a run of at least
+    threshold distinct channels with no gap larger than tolerance channels
+    between neighbours, i.e. a track across adjacent wires.
+    :param data: Time ordered (rows, dataset columns) int64 array.
+    :param window: Length of the windows in ticks.
+    :param threshold: Smallest number of adjacent channels that triggers.
+    :param tolerance: Largest channel gap within a run of adjacent channels.
+    :return: (candidates, 2) int64 array of [begin, end) windows in ticks
+    """
+    if len(data) == 0:
+        return np.empty((0, 2), dtype=np.int64)
+    time_shift = data[0, TIME_COLUMN]
+    window_index = (data[:, TIME_COLUMN] - time_shift)//window
+    channels = data[:, CHANNEL_COLUMN]
+    channel_min = channels.min()
+    num_channels = channels.max() - channel_min + 1
+    # Distinct (window, channel) pairs, ordered by window then channel. A sort and
+    # a mask is much faster than np.unique on millions of keys.
+    keys = np.sort(window_index*num_channels + (channels - channel_min))
+    keys = keys[np.concatenate(([True], keys[1:] != keys[:-1]))]
+    key_window = keys//num_channels
+    key_channel = keys % num_channels
+
+    new_run = np.concatenate(([True], (np.diff(key_window) != 0) | (np.diff(key_channel) > tolerance)))
+    run_begins = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_begins, len(keys)))
+    triggering = np.unique(key_window[run_begins[run_lengths >= threshold]])
+    begins = time_shift + triggering*window
+    return np.column_stack((begins, begins + window))
+
+
+def find_candidates(data, algorithm, window, threshold, tolerance=1):
+    """
+    Run one of the ALGORITHMS over a time ordered dataset.
+    :return: (candidates, 2) int64 array of [begin, end) windows in ticks
+    """
+    if algorithm == "adc_sum":
+        return adc_sum_windows(data, window, threshold)
+    return adjacency_windows(data, window, threshold, tolerance)
+
+
+def select_triggered(data, candidates, before=0, after=0):
+    """
+    Select the dataset TPs read out by the candidates, each read out over
+    [begin - before, end + after). Overlapping readout windows select each TP once.
+    :param data: Time ordered (rows, dataset columns) int64 array.
+    :param candidates: (candidates, 2) int64 array of [begin, end) windows in ticks.
+    :param before: Readout ticks before each candidate.
+    :param after: Readout ticks after each candidate.
+    :return: boolean array, True for the triggered TPs
+    """
+    times = data[:, TIME_COLUMN]
+    begins = np.searchsorted(times, candidates[:, 0] - before, side='left')
+    ends = np.searchsorted(times, candidates[:, 1] + after, side='left')
+    # Count the windows covering each TP with a difference array
+    coverage = np.bincount(begins, minlength=len(times) + 1) - np.bincount(ends, minlength=len(times) + 1)
+    return np.cumsum(coverage[:-1]) > 0
+
+
+def summarise(data, candidates, triggered, threshold):
+    """
+    Summary numbers of one threshold point.
+    """
+    duration = (data[-1, TIME_COLUMN] - data[0, TIME_COLUMN] + 1)*16e-9 if len(data) else 0
+    return {"threshold": threshold, "num_candidates": len(candidates),
+            "rate_hz": len(candidates)/duration if duration else 0.,
+            "num_triggered_tps": int(triggered.sum()),
+            "adc_fraction": data[triggered, ADC_COLUMN].sum()/max(data[:, ADC_COLUMN].sum(), 1)}
+
+
+def load_worker_data(file):
+    global WORKER_DATA
+    WORKER_DATA = read_dataset(file)
+
+
+def run_point(algorithm, window, threshold, tolerance, before, after):
+    """
+    Sweep worker: one threshold point over the dataset loaded in this process.
+    """
+    candidates = find_candidates(WORKER_DATA, algorithm, window, threshold, tolerance)
+    return summarise(WORKER_DATA, candidates, select_triggered(WORKER_DATA, candidates, before, after), threshold)
+
+
+def sweep(file, algorithm, window, thresholds, tolerance, before, after, jobs=1):
+    """
+    Run the algorithm over the dataset for every threshold, with a pool of
+    jobs processes that each load the dataset once.
+    :return: list of summaries, in threshold order
+    """
+    args = ([algorithm]*len(thresholds), [window]*len(thresholds), thresholds, [tolerance]*len(thresholds),
+            [before]*len(thresholds), [after]*len(thresholds))
+    if jobs == 1:
+        load_worker_data(file)
+        return list(map(run_point, *args))
+    with ProcessPoolExecutor(max_workers=jobs, initializer=load_worker_data, initargs=(file,)) as pool:
+        return list(pool.map(run_point, *args))
+
+
+def save_sweep(file, summaries):
+    names = ("threshold", "num_candidates", "rate_hz", "num_triggered_tps", "adc_fraction")
+    table = np.array([[summary[name] for name in names] for summary in summaries], dtype=float)
+    np.savetxt(file, table, fmt=["%.9g", "%d", "%.6g", "%d", "%.6f"], delimiter=",", header=",".join(names),
+               comments="")
+
+
+def parse_thresholds(text):
+    """
+    Parse a comma separated threshold list, or a start:stop:step range.
+    """
+    if ":" in text:
+        start, stop, step = (float(value) for value in text.split(":"))
+        return list(np.arange(start, stop + step/2, step))
+    return [float(value) for value in text.split(",")]
+
+
+def main(file, out, algorithm, window, threshold, tolerance, before, after, binary, windows_out):
+    data = read_dataset(file)
+    print("Running the ", algorithm, " algorithm over ", len(data), " TPs...")
+    candidates = find_candidates(data, algorithm, window, threshold, tolerance)
+    triggered = select_triggered(data, candidates, before, after)
+    summary = summarise(data, candidates, triggered, threshold)
+    print("Found ", summary["num_candidates"], " candidates (", round(summary["rate_hz"], 2), " Hz), reading out ",
+          summary["num_triggered_tps"], " TPs with ", round(100*summary["adc_fraction"], 2), "% of the ADC sum.")
+
+    if binary:
+        write_tp_binary(out, data[triggered])
+    else:
+        write_tp_text(out, data[triggered])
+    print("Wrote the triggered TPs to ", out)
+    if windows_out:
+        np.savetxt(windows_out, candidates, fmt="%d", header="begin end", comments="")
+        print("Wrote the candidate windows to ", windows_out)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Emulate the trigger activity algorithms over an offline TP dataset")
+    parser.add_argument('-f', '--file', dest='file', required=True, help='Offline TP dataset, text or binary')
+    parser.add_argument('-o', '--out', dest='out', default=None,
+                        help='Output file of the triggered TPs, in the dataset format, or of the sweep summary.'
+                             + ' Defaults to offline_triggered_tps.txt, or trigger_sweep.csv with --sweep')
+    parser.add_argument('-a', '--algorithm', choices=ALGORITHMS, default="adc_sum",
+                        help='ADC sum threshold within a window, or channel adjacency')
+    parser.add_argument('-w', '--window', dest='window', type=float, default=1e-4,
+                        help='Algorithm time window in seconds')
+    parser.add_argument('-t', '--threshold', dest='threshold', type=float, default=100000,
+                        help='ADC sum threshold, or smallest number of adjacent channels')
+    parser.add_argument('--tolerance', dest='tolerance', type=int, default=1,
+                        help='Largest channel gap between adjacent channels')
+    parser.add_argument('--readout-before', dest='before', type=float, default=0,
+                        help='Readout time before each candidate window in seconds')
+    parser.add_argument('--readout-after', dest='after', type=float, default=0,
+                        help='Readout time after each candidate window in seconds')
+    parser.add_argument('-b', '--binary', action="store_true", help="Write the binary TP dataset format")
+    parser.add_argument('--windows', dest='windows', default=None,
+                        help='Also save the candidate windows, in ticks, to this file')
+    parser.add_argument('--sweep', dest='sweep', default=None,
+                        help='Sweep the threshold over a comma separated list or a start:stop:step range instead,'
+                             + ' saving the summary of each point as csv')
+    parser.add_argument('-j', '--jobs', dest='jobs', type=int, default=1,
+                        help='Number of processes running the sweep points')
+
+    args = parser.parse_args()
+    window = max(int(round(args.window/16e-9)), 1)
+    before = int(round(args.before/16e-9))
+    after = int(round(args.after/16e-9))
+
+    if args.sweep:
+        summaries = sweep(args.file, args.algorithm, window, parse_thresholds(args.sweep), args.tolerance,
+                          before, after, args.jobs)
+        print("threshold  candidates  rate(Hz)  triggered_tps  adc_fraction")
+        for summary in summaries:
+            print(summary["threshold"], " ", summary["num_candidates"], " ", round(summary["rate_hz"], 2), " ",
+                  summary["num_triggered_tps"], " ", round(summary["adc_fraction"], 4))
+        out = args.out if args.out else "trigger_sweep.csv"
+        save_sweep(out, summaries)
+        print("Saved the sweep to ", out)
+    else:
+        main(args.file, args.out if args.out else "offline_triggered_tps.txt", args.algorithm, window, args.threshold,
+             args.tolerance, before, after, args.binary, args.windows)